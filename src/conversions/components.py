@@ -0,0 +1,265 @@
+"""
+Label the 3D connected components of a stack and group points by them.
+
+Every mask is labelled on its own with cv2.connectedComponents, then
+labels of neighbouring slices that overlap are merged with a union find.
+Points are grouped so that each component is one contiguous range, which
+lets a renderer show or hide a component by the range it draws.
+
+Exported classes StackComponents, ComponentCloud
+Exported functions labelComponents
+Private functions begin with an _
+"""
+import cv2
+import numpy as np
+from conversions.tiff_to_ply import createMask, SLICE_THICKNESS, XY_SCALE
+
+
+def _findRoots(num_labels, first, second):
+    """
+    Merge labels joined by edges into their smallest label.
+
+    Every round hooks the larger root of each edge onto the smaller one
+    and then shortens every path to its root.
+
+    Parameters:
+    - num_labels (int): Number of labels
+    - first (numpy.ndarray): One label of every edge
+    - second (numpy.ndarray): The other label of every edge
+
+    Returns:
+    - numpy.ndarray: (num_labels,) root of every label
+    """
+    parent = np.arange(num_labels)
+    while True:
+        root_first, root_second = parent[first], parent[second]
+        joined = root_first != root_second
+        if not np.any(joined):
+            return parent
+        first, second = first[joined], second[joined]
+        root_first, root_second = root_first[joined], root_second[joined]
+        np.minimum.at(parent, np.maximum(root_first, root_second),
+                      np.minimum(root_first, root_second))
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+
+
+def _sliceLabels(mask):
+    """
+    Label the 8 connected components of a mask.
+
+    Parameters:
+    - mask (numpy.ndarray): Mask with 255 for kept pixels
+
+    Returns:
+    - int: number of labels including the background 0
+    - numpy.ndarray: int32 label of every pixel
+    - numpy.ndarray: stats of every label, see
+      cv2.connectedComponentsWithStats
+    """
+    return cv2.connectedComponentsWithStats(mask, connectivity=8,
+                                            ltype=cv2.CV_32S)[:3]
+
+
+class StackComponents():
+    """
+    The 3D connected components of the masks of a stack.
+
+    Pixels are connected to their 8 neighbours in a slice and to the
+    pixel at the same place in the slices before and after it.
+    """
+
+    def __init__(self, images, threshold=None):
+        """
+        Label the components of a stack.
+
+        Only the masks of two slices are held at once.
+
+        Parameters:
+        - images (list of numpy.ndarray): Grayscale slices
+        - threshold (int, optional): Highest intensity kept in the masks,
+          see createMask
+
+        Returns:
+        - New stack components
+        """
+        self._images = images
+        self._threshold = threshold
+        # first global label of every slice's labels
+        self._offsets = np.zeros(len(images) + 1, dtype=np.int64)
+        firsts, seconds = [], []
+        boxes, areas = [np.zeros((1, 4), dtype=np.int64)], [[0]]
+        previous_mask = previous_labels = None
+        for index, image in enumerate(images):
+            mask = createMask(image, threshold)
+            num_labels, labels, stats = _sliceLabels(mask)
+            # label l of the slice is global label offset + l, the
+            # background is never looked up
+            offset = self._offsets[index]
+            self._offsets[index + 1] = self._offsets[index] + num_labels - 1
+            boxes.append(stats[1:, :4])
+            areas.append(stats[1:, 4])
+            if previous_mask is not None:
+                overlap = (mask & previous_mask).ravel() != 0
+                first = previous_labels.ravel()[overlap] + previous_offset
+                second = labels.ravel()[overlap] + offset
+                # runs of equal pairs along rows only need one edge
+                if len(first) > 0:
+                    change = np.ones(len(first), dtype=bool)
+                    change[1:] = (first[1:] != first[:-1]) | \
+                        (second[1:] != second[:-1])
+                    pairs = np.unique((first[change].astype(np.int64) << 32)
+                                      | second[change])
+                    firsts.append(pairs >> 32)
+                    seconds.append(pairs & 0xffffffff)
+            previous_mask, previous_labels = mask, labels
+            previous_offset = offset
+
+        total = int(self._offsets[-1]) + 1
+        roots = _findRoots(total,
+                           np.concatenate(firsts or [np.empty(0, np.int64)]),
+                           np.concatenate(seconds or [np.empty(0, np.int64)]))
+        # number the roots from 1 in order of their first slice
+        unique_roots, self._global = np.unique(roots, return_inverse=True)
+        self._global = self._global.reshape(-1).astype(np.int32)
+        self.count = len(unique_roots) - 1
+
+        # voxel counts and bounds of every component from the slice stats
+        boxes = np.concatenate(boxes)
+        slices = np.concatenate(([0], np.repeat(np.arange(len(images)),
+                                                np.diff(self._offsets))))
+        self.voxels = np.bincount(self._global,
+                                  np.concatenate(areas).astype(np.float64),
+                                  minlength=self.count + 1).astype(np.int64)
+        self.voxel_mins = np.full((self.count + 1, 3), np.iinfo(np.int64).max)
+        self.voxel_maxs = np.full((self.count + 1, 3), -1)
+        for axis, low, high in ((0, boxes[:, 0], boxes[:, 0] + boxes[:, 2]),
+                                (1, boxes[:, 1], boxes[:, 1] + boxes[:, 3]),
+                                (2, slices, slices + 1)):
+            np.minimum.at(self.voxel_mins[:, axis], self._global, low)
+            np.maximum.at(self.voxel_maxs[:, axis], self._global, high - 1)
+
+    def labelPoints(self, points):
+        """
+        Get the component of every point extracted from the stack.
+
+        The slices holding points are labelled again, so no labels are
+        kept between calls.
+
+        Parameters:
+        - points (numpy.ndarray): (n, 3) points from extractPoints with
+          the same threshold
+
+        Returns:
+        - numpy.ndarray: (n,) int32 labels from 1, 0 for points outside
+          the masks
+        """
+        points = np.asarray(points)
+        point_labels = np.zeros(len(points), dtype=np.int32)
+        if len(points) == 0:
+            return point_labels
+        slice_index = np.rint(points[:, 2] / SLICE_THICKNESS).astype(
+            np.int64) + 1
+        rows = np.rint(points[:, 1] / XY_SCALE).astype(np.int64)
+        cols = np.rint(points[:, 0] / XY_SCALE).astype(np.int64)
+        order = np.argsort(slice_index, kind="stable")
+        bounds = np.searchsorted(slice_index[order],
+                                 np.arange(len(self._images) + 1))
+        for index in range(len(self._images)):
+            members = order[bounds[index]:bounds[index + 1]]
+            if len(members) == 0:
+                continue
+            mask = createMask(self._images[index], self._threshold)
+            labels = _sliceLabels(mask)[1]
+            local = labels[rows[members], cols[members]]
+            point_labels[members] = np.where(
+                local > 0, self._global[local + self._offsets[index]], 0)
+        return point_labels
+
+
+class ComponentCloud():
+    """
+    Points ordered so every component is one contiguous range.
+
+    Components are ordered from the most points to the fewest, so the
+    largest structures are the first ranges.
+    """
+
+    def __init__(self, points, labels):
+        """
+        Group points by their component.
+
+        Parameters:
+        - points (numpy.ndarray): (n, 3) array of points
+        - labels (numpy.ndarray): (n,) component of every point
+
+        Returns:
+        - A new component cloud
+        """
+        points = np.asarray(points, dtype=np.float32)
+        labels = np.asarray(labels)
+        present, inverse, counts = np.unique(labels, return_inverse=True,
+                                             return_counts=True)
+        inverse = inverse.reshape(-1)
+        # rank of every label by its number of points
+        by_size = np.argsort(-counts, kind="stable")
+        rank = np.empty_like(by_size)
+        rank[by_size] = np.arange(len(by_size))
+        order = np.argsort(rank[inverse], kind="stable")
+        self.points = points[order]
+        self.labels = labels[order]
+        # stack label, start, number of points and bounds of every range
+        self.components = present[by_size]
+        self.counts = counts[by_size]
+        self.starts = np.concatenate(([0], np.cumsum(self.counts)[:-1]))
+        if len(points) > 0:
+            self.mins = np.minimum.reduceat(self.points, self.starts)
+            self.maxs = np.maximum.reduceat(self.points, self.starts)
+        else:
+            self.mins = self.maxs = np.empty((0, 3), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def ranges(self, visible):
+        """
+        Get the ranges of points to draw for the visible components.
+
+        Neighbouring visible components are merged into one range.
+
+        Parameters:
+        - visible (numpy.ndarray): (len(self),) bool, whether each
+          component is drawn
+
+        Returns:
+        - list of (int, int): offset and count of every range
+        """
+        visible = np.asarray(visible, dtype=bool)
+        edges = np.diff(np.concatenate(([False], visible, [False])).astype(
+            np.int8))
+        firsts = np.flatnonzero(edges == 1)
+        lasts = np.flatnonzero(edges == -1)
+        ends = self.starts[lasts - 1] + self.counts[lasts - 1]
+        return [(int(self.starts[first]), int(end - self.starts[first]))
+                for first, end in zip(firsts, ends)]
+
+
+def labelComponents(images, points, threshold=None):
+    """
+    Label the components of a stack and group its points by them.
+
+    Parameters:
+    - images (list of numpy.ndarray): Grayscale slices
+    - points (numpy.ndarray): (n, 3) points from extractPoints with the
+      same threshold
+    - threshold (int, optional): Highest intensity kept in the masks,
+      see createMask
+
+    Returns:
+    - ComponentCloud: the grouped points
+    """
+    components = StackComponents(images, threshold)
+    return ComponentCloud(points, components.labelPoints(points))
@@ -0,0 +1,271 @@
+"""
+Reduce point clouds to a spacing or a number of points.
+
+Voxel grid decimation replaces the points in every cubic cell by their
+centroid. Poisson disk decimation keeps a subset of the points in which
+no two are closer than the spacing, and every dropped point is within
+the spacing of a kept one.
+
+Exported classes Decimation
+Exported functions voxelGrid, poissonDisk
+Private functions begin with an _
+"""
+import math
+import time
+import numpy as np
+
+# offsets of a cell and its 26 neighbours
+_neighbours = np.array([(x, y, z) for x in (-1, 0, 1)
+                        for y in (-1, 0, 1) for z in (-1, 0, 1)])
+# spacings tried when searching for a number of points
+_max_trials = 8
+# counts up to this fraction above the target end the search
+_tolerance = 0.05
+
+
+def _cellKeys(points, spacing, padding=0):
+    """
+    Get the cell of every point as one integer.
+
+    Parameters:
+    - points (numpy.ndarray): (n, 3) array of points
+    - spacing (float): Edge length of the cells
+    - padding (int): Empty cells kept around the cloud on every side
+
+    Returns:
+    - numpy.ndarray: (n,) int64 cell keys
+    - numpy.ndarray: (3,) number of cells along each axis
+    """
+    cells = np.floor((points - points.min(axis=0)) / spacing).astype(np.int64)
+    cells += padding
+    dims = cells.max(axis=0) + 1 + padding
+    return (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2], dims
+
+
+def voxelGrid(points, spacing):
+    """
+    Replace the points in every cell of a grid by their centroid.
+
+    Parameters:
+    - points (numpy.ndarray): (n, 3) array of points
+    - spacing (float): Edge length of the cells
+
+    Returns:
+    - numpy.ndarray: (m, 3) float32 array of centroids, ordered by cell
+    """
+    points = np.asarray(points, dtype=np.float32)
+    if len(points) == 0:
+        return points.reshape(0, 3)
+    keys, _ = _cellKeys(points, spacing)
+    _, inverse, counts = np.unique(keys, return_inverse=True,
+                                   return_counts=True)
+    inverse = inverse.reshape(-1)
+    centroids = np.empty((len(counts), 3), dtype=np.float32)
+    for axis in range(3):
+        centroids[:, axis] = np.bincount(inverse, points[:, axis]) / counts
+    return centroids
+
+
+def poissonDisk(points, spacing, seed=None):
+    """
+    Keep a subset of points in which no two are closer than spacing.
+
+    Points are drawn in a random order from cells with an edge length of
+    spacing. Cells are visited in eight interleaved phases, so the points
+    drawn in one phase are at least a cell apart and can all be kept at
+    once. The points within spacing of them, which can only lie in the
+    27 cells around them, are then dropped.
+
+    Parameters:
+    - points (numpy.ndarray): (n, 3) array of points
+    - spacing (float): Smallest distance between kept points
+    - seed (int, optional): Seed for the drawing order
+
+    Returns:
+    - numpy.ndarray: (m, 3) float32 array of the kept points, in the
+      order of points
+    """
+    points = np.asarray(points, dtype=np.float32)
+    if len(points) == 0:
+        return points.reshape(0, 3)
+    keys, dims = _cellKeys(points, spacing, padding=1)
+    cell_keys, cell_of = np.unique(keys, return_inverse=True)
+    cell_of = cell_of.reshape(-1)
+    cells = np.stack(np.unravel_index(cell_keys, dims), axis=1)
+    cell_phases = (cells[:, 0] % 2) * 4 + (cells[:, 1] % 2) * 2 + \
+        cells[:, 2] % 2
+    # the occupied neighbours of every occupied cell, len(cell_keys) if empty
+    offsets = (_neighbours[:, 0] * dims[1] + _neighbours[:, 1]) * dims[2] + \
+        _neighbours[:, 2]
+    neighbours = np.empty((len(offsets), len(cell_keys)), dtype=np.int64)
+    for row, offset in enumerate(offsets):
+        index = np.searchsorted(cell_keys, cell_keys + offset)
+        index = np.minimum(index, len(cell_keys) - 1)
+        neighbours[row] = np.where(cell_keys[index] == cell_keys + offset,
+                                   index, len(cell_keys))
+    limit = np.float32(spacing) ** 2
+
+    # ordered by cell and randomly within cells
+    priority = np.random.default_rng(seed).random(len(points))
+    remaining = np.lexsort((priority, cell_of))
+    # the point chosen in every cell this round, -1 for none
+    chosen_in = np.full(len(cell_keys) + 1, -1, dtype=np.int64)
+    kept = []
+    phase = 0
+    while len(remaining) > 0:
+        remaining_cells = cell_of[remaining]
+        candidates = np.flatnonzero(cell_phases[remaining_cells] == phase)
+        phase = (phase + 1) % 8
+        if len(candidates) == 0:
+            continue
+        # the first candidate of every cell
+        candidate_cells = remaining_cells[candidates]
+        first = np.ones(len(candidates), dtype=bool)
+        first[1:] = candidate_cells[1:] != candidate_cells[:-1]
+        chosen = remaining[candidates[first]]
+        chosen_cells = candidate_cells[first]
+        kept.append(chosen)
+        chosen_in[chosen_cells] = chosen
+
+        # drop every remaining point within spacing of a chosen one
+        remaining_points = points[remaining]
+        dropped = np.zeros(len(remaining), dtype=bool)
+        for row in neighbours:
+            near = chosen_in[row[remaining_cells]]
+            index = np.flatnonzero(near >= 0)
+            distances = ((remaining_points[index] -
+                          points[near[index]]) ** 2).sum(axis=1)
+            dropped[index[distances < limit]] = True
+        chosen_in[chosen_cells] = -1
+        remaining = remaining[~dropped]
+    return points[np.sort(np.concatenate(kept))]
+
+
+def _spacingForTarget(points, target, sample):
+    """
+    Find the spacing at which a decimation keeps about target points.
+
+    Counts fall with the spacing close to a power law, so each trial
+    steps along the line through the last two trials in log space.
+
+    Parameters:
+    - points (numpy.ndarray): (n, 3) array of points
+    - target (int): Number of points wanted
+    - sample (callable): Decimation taking points and a spacing
+
+    Returns:
+    - float: the spacing
+    - numpy.ndarray: the decimated points, at least target of them
+      unless no trial kept that many
+    """
+    extent = float(np.ptp(points, axis=0).max())
+    # clouds from slices are mostly surfaces, so counts fall with spacing^2
+    spacing = max(extent, 1e-6) / math.sqrt(target)
+    trials = []
+    for _ in range(_max_trials):
+        result = sample(points, spacing)
+        trials.append((spacing, result))
+        if target <= len(result) <= target * (1 + _tolerance):
+            break
+        slope = -2.0
+        if len(trials) > 1:
+            (spacing_a, result_a), (spacing_b, result_b) = trials[-2:]
+            if spacing_a != spacing_b and len(result_a) != len(result_b):
+                slope = math.log(len(result_b) / len(result_a)) / \
+                    math.log(spacing_b / spacing_a)
+            slope = min(slope, -0.5)
+        spacing *= (target / max(len(result), 1)) ** (1 / slope)
+    enough = [trial for trial in trials if len(trial[1]) >= target]
+    if len(enough) > 0:
+        return min(enough, key=lambda trial: len(trial[1]))
+    return max(trials, key=lambda trial: len(trial[1]))
+
+
+class Decimation():
+    """
+    A decimation stage for clouds on their way to a file or a renderer.
+
+    The stage is configured once and applied to every cloud, the report
+    of the last cloud is kept in report.
+    """
+
+    methods = ("voxel", "poisson")
+
+    def __init__(self, method="voxel", spacing=None, target=None, seed=None):
+        """
+        Initialize a decimation stage.
+
+        Parameters:
+        - method (str): "voxel" for voxel grid centroids or "poisson" for
+          a Poisson disk subset
+        - spacing (float, optional): Cell edge length or smallest
+          distance between kept points
+        - target (int, optional): Number of points to keep, used when
+          spacing is None, clouds already this small are kept whole
+
+        Returns:
+        - A new decimation stage
+        """
+        if method not in self.methods:
+            raise ValueError(f"Unknown decimation method: {method}")
+        if spacing is None and target is None:
+            raise ValueError("Decimation needs a spacing or a target")
+        self.method = method
+        self.spacing = spacing
+        self.target = target
+        self._rng = np.random.default_rng(seed)
+        self.report = None
+
+    def __call__(self, points):
+        """
+        Decimate a cloud.
+
+        Parameters:
+        - points (numpy.ndarray): (n, 3) array of points
+
+        Returns:
+        - numpy.ndarray: (m, 3) float32 array of points
+        """
+        points = np.asarray(points, dtype=np.float32)
+        start = time.perf_counter()
+        spacing = self.spacing
+        if spacing is not None:
+            result = self._sample(points, spacing)
+        elif len(points) <= self.target:
+            result = points
+        else:
+            spacing, result = _spacingForTarget(points, self.target,
+                                                self._sample)
+            if len(result) > self.target:
+                # a random subset keeps the spacing of either method
+                keep = self._rng.choice(len(result), self.target,
+                                        replace=False)
+                result = result[np.sort(keep)]
+        self.report = {"method": self.method,
+                       "spacing": spacing,
+                       "input": len(points),
+                       "output": len(result),
+                       "ratio": len(result) / max(len(points), 1),
+                       "seconds": time.perf_counter() - start}
+        return result
+
+    def describe(self):
+        """
+        Describe the last decimation.
+
+        Returns:
+        - str: method, point counts, reduction ratio and time
+        """
+        if self.report is None:
+            return f"{self.method} decimation: not run"
+        report = self.report
+        return (f"{report['method']} decimation: {report['input']} -> "
+                f"{report['output']} points ({report['ratio']:.1%}) "
+                f"in {report['seconds'] * 1e3:.0f} ms")
+
+    def _sample(self, points, spacing):
+        """Decimate points at a spacing with the stage's method."""
+        if self.method == "voxel":
+            return voxelGrid(points, spacing)
+        return poissonDisk(points, spacing,
+                           int(self._rng.integers(2**31)))
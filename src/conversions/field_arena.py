@@ -0,0 +1,333 @@
+"""
+Reusable taichi field storage for point clouds.
+
+Exported classes FieldArena, FieldPool, StagingFields
+Private functions begin with an _
+"""
+import bisect
+import numpy as np
+from __main__ import ti
+
+
+@ti.kernel
+def _writePoints(field: ti.template(), arr: ti.types.ndarray(),
+                 offset: ti.i32, length: ti.i32):
+    for i in range(length):
+        field[offset + i] = ti.Vector([arr[i, 0], arr[i, 1], arr[i, 2]])
+
+
+@ti.kernel
+def _copyPoints(field: ti.template(), source: ti.template(),
+                offset: ti.i32, source_offset: ti.i32, length: ti.i32):
+    for i in range(length):
+        field[offset + i] = source[source_offset + i]
+
+
+@ti.kernel
+def _fillColor(field: ti.template(), offset: ti.i32, length: ti.i32,
+               red: ti.f32, green: ti.f32, blue: ti.f32):
+    for i in range(length):
+        field[offset + i] = ti.Vector([red, green, blue])
+
+
+class FieldArena():
+    """
+    A growable ti.Vector.field that point clouds are copied into.
+
+    The field lives in its own SNode tree so it can be destroyed when it
+    has to grow, instead of being left in the global field tree.
+    Capacity doubles, so loading clouds of similar size only copies the
+    points into the existing field.
+    """
+
+    def __init__(self, capacity=1024):
+        """
+        Initialize a new arena.
+
+        Parameters:
+        - capacity (int): Number of points to allocate room for
+
+        Returns:
+        - A new field arena
+        """
+        self.field = None
+        self.capacity = 0
+        # number of live points at the start of the field
+        self.count = 0
+        self._tree = None
+        self._allocate(max(capacity, 1))
+
+    def load(self, points):
+        """
+        Replace the contents of the arena with points.
+
+        Parameters:
+        - points (numpy.ndarray): (n, 3) array of points
+
+        Returns:
+        - field (ti.Vector.field): the field holding the points,
+          only the first count entries are live
+        """
+        points = np.ascontiguousarray(points, dtype=np.float32)
+        num_points = points.shape[0]
+        if num_points > self.capacity:
+            capacity = self.capacity
+            while capacity < num_points:
+                capacity *= 2
+            self._allocate(capacity)
+        if num_points > 0:
+            _writePoints(self.field, points, 0, num_points)
+        self.count = num_points
+        return self.field
+
+    def append(self, points):
+        """
+        Add points after the live points of the arena.
+
+        Parameters:
+        - points (numpy.ndarray): (n, 3) array of points
+
+        Returns:
+        - field (ti.Vector.field): the field holding the points,
+          only the first count entries are live
+        """
+        points = np.ascontiguousarray(points, dtype=np.float32)
+        num_points = points.shape[0]
+        needed = self.count + num_points
+        if needed > self.capacity:
+            live = self.field.to_numpy()[:self.count]
+            capacity = self.capacity
+            while capacity < needed:
+                capacity *= 2
+            self._allocate(capacity)
+            if len(live) > 0:
+                _writePoints(self.field, live, 0, len(live))
+            self.count = len(live)
+        if num_points > 0:
+            _writePoints(self.field, points, self.count, num_points)
+        self.count = needed
+        return self.field
+
+    def destroy(self):
+        """Free the field, the arena can't be used after this."""
+        if self._tree is not None:
+            self._tree.destroy()
+        self._tree = None
+        self.field = None
+        self.capacity = 0
+        self.count = 0
+
+    def _allocate(self, capacity):
+        """
+        Destroy the current field and create an empty one.
+
+        Parameters:
+        - capacity (int): Number of points the new field holds
+        """
+        if self._tree is not None:
+            self._tree.destroy()
+        builder = ti.FieldsBuilder()
+        field = ti.Vector.field(3, dtype=ti.f32)
+        builder.dense(ti.i, capacity).place(field)
+        self._tree = builder.finalize()
+        self.field = field
+        self.capacity = capacity
+        self.count = 0
+
+
+class FieldPool():
+    """
+    A fixed size ti.Vector.field that ranges of points are allocated in.
+
+    Ranges go in the first free gap that fits them and freed ranges are
+    merged with the gaps next to them, so clouds that come and go, like
+    streamed tiles, are copied in once and never moved. Allocating and
+    freeing only keep the books, so they can run on another thread than
+    the writes.
+    """
+
+    def __init__(self, capacity):
+        """
+        Initialize a pool, allocating its field.
+
+        Parameters:
+        - capacity (int): Number of points the field holds
+
+        Returns:
+        - A new field pool
+        """
+        capacity = max(capacity, 1)
+        builder = ti.FieldsBuilder()
+        self.field = ti.Vector.field(3, dtype=ti.f32)
+        builder.dense(ti.i, capacity).place(self.field)
+        self._tree = builder.finalize()
+        self.capacity = capacity
+        # number of points in allocated ranges
+        self.used = 0
+        # (start, length) of every free gap, sorted by start
+        self._gaps = [(0, capacity)]
+        # start to length of every allocated range
+        self._ranges = {}
+
+    def allocate(self, count):
+        """
+        Reserve a range of the field.
+
+        Parameters:
+        - count (int): Number of points in the range, at least one
+
+        Returns:
+        - int or None: start of the range, None if no gap fits it
+        """
+        for index, (start, length) in enumerate(self._gaps):
+            if length >= count:
+                if length == count:
+                    del self._gaps[index]
+                else:
+                    self._gaps[index] = (start + count, length - count)
+                self._ranges[start] = count
+                self.used += count
+                return start
+        return None
+
+    def free(self, start):
+        """
+        Release a range so its points can be overwritten.
+
+        Parameters:
+        - start (int): Start of the range, as returned by allocate
+        """
+        length = self._ranges.pop(start)
+        self.used -= length
+        index = bisect.bisect(self._gaps, (start, length))
+        if index < len(self._gaps) and \
+           self._gaps[index][0] == start + length:
+            length += self._gaps.pop(index)[1]
+        if index > 0 and sum(self._gaps[index - 1]) == start:
+            index -= 1
+            start, before = self._gaps.pop(index)
+            length += before
+        self._gaps.insert(index, (start, length))
+
+    def write(self, start, points):
+        """
+        Copy points into an allocated range.
+
+        Parameters:
+        - start (int): Start of the range
+        - points (numpy.ndarray): (n, 3) array of points, n no more
+          than the length of the range
+        """
+        points = np.ascontiguousarray(points, dtype=np.float32)
+        if len(points) > 0:
+            _writePoints(self.field, points, start, len(points))
+
+    def destroy(self):
+        """Free the field, the pool can't be used after this."""
+        if self._tree is not None:
+            self._tree.destroy()
+        self._tree = None
+        self.field = None
+
+
+class StagingFields():
+    """
+    Power of two sized fields that ranges of a point field are gathered into.
+
+    Drawing a field copies all of it to the vertex buffer, however few of
+    its points are drawn. Gathering the drawn ranges into the smallest
+    staging field that holds them keeps that copy to the drawn points.
+    Every size is allocated once, in its own SNode tree.
+    """
+
+    def __init__(self, min_size=1024):
+        """
+        Initialize new staging fields, none are allocated until used.
+
+        Parameters:
+        - min_size (int): Size of the smallest staging field
+
+        Returns:
+        - New staging fields
+        """
+        self._min_size = max(min_size, 1)
+        # size -> (tree, field), for the points and their colors
+        self._fields = {}
+        self._color_fields = {}
+        # source, ranges and colors last gathered, to skip gathering
+        # them again
+        self._gathered = None
+
+    def gather(self, source, ranges, colors=None):
+        """
+        Copy ranges of a field one after another into a staging field.
+
+        Gathering the same ranges of the same field again doesn't copy,
+        call invalidate when the contents of the field change.
+
+        Parameters:
+        - source (ti.Vector.field): Field the ranges are in
+        - ranges (list of (int, int)): Offset and count of every range
+        - colors (list of tuple, optional): Color of every range, filled
+          into a color field of the same size
+
+        Returns:
+        - field (ti.Vector.field): the staging field
+        - color_field (ti.Vector.field or None): the color of every
+          point, None if no colors were given
+        - int: number of gathered points at the start of them
+        """
+        ranges = [(int(start), int(length)) for start, length in ranges]
+        colors = None if colors is None else [tuple(color)
+                                               for color in colors]
+        count = sum(length for _, length in ranges)
+        size = self._min_size
+        while size < count:
+            size *= 2
+        field = self._field(self._fields, size)
+        color_field = None
+        if colors is not None:
+            color_field = self._field(self._color_fields, size)
+        key = (id(source), size, ranges, colors)
+        if key != self._gathered:
+            offset = 0
+            for index, (start, length) in enumerate(ranges):
+                if length > 0:
+                    _copyPoints(field, source, offset, start, length)
+                    if colors is not None:
+                        _fillColor(color_field, offset, length,
+                                   *colors[index])
+                offset += length
+            self._gathered = key
+        return field, color_field, count
+
+    def invalidate(self):
+        """Make the next gather copy even if its ranges are unchanged."""
+        self._gathered = None
+
+    def destroy(self):
+        """Free every staging field."""
+        for fields in (self._fields, self._color_fields):
+            for tree, _ in fields.values():
+                tree.destroy()
+        self._fields = {}
+        self._color_fields = {}
+        self._gathered = None
+
+    def _field(self, fields, size):
+        """
+        Get the staging field of a size, allocating it the first time.
+
+        Parameters:
+        - fields (dict): The fields by size to take it from
+        - size (int): Number of entries the field holds
+
+        Returns:
+        - field (ti.Vector.field): the staging field
+        """
+        if size not in fields:
+            builder = ti.FieldsBuilder()
+            field = ti.Vector.field(3, dtype=ti.f32)
+            builder.dense(ti.i, size).place(field)
+            fields[size] = (builder.finalize(), field)
+        return fields[size][1]
@@ -0,0 +1,356 @@
+"""
+Order point clouds along a 3D Morton (Z-order) curve and query boxes.
+
+Points close in space are close in the Morton order, which keeps
+rendering and compression local and lets a box be read as one range.
+The order is split into blocks of points and the code range and byte
+offset of every block is kept in an index next to the PLY file, so a
+box query is a binary search over the blocks and one contiguous read.
+
+Layout of the index, <ply file>.morton.json:
+    - origin, cell: grid the codes are computed on
+    - block_points: points per block
+    - firsts, lasts: smallest and largest code of every block
+    - offsets: byte offset of every block in the PLY file, and its end
+
+Benchmark against the lexicographic order with (from src):
+    python -m conversions.morton <stack> [size]
+
+Exported functions mortonCodes, mortonOrder, writeMortonIndex,
+readMortonIndex, queryBox
+Private functions begin with an _
+"""
+import json
+import numpy as np
+
+# bits of every axis in a 63 bit code
+_bits = 21
+_index_suffix = ".morton.json"
+
+
+def _spreadBits(values):
+    """
+    Move the low 21 bits of every value to every third bit.
+
+    Parameters:
+    - values (numpy.ndarray): uint64 values
+
+    Returns:
+    - numpy.ndarray: uint64 spread values
+    """
+    values = values & np.uint64(0x1fffff)
+    for shift, mask in ((32, 0x1f00000000ffff), (16, 0x1f0000ff0000ff),
+                        (8, 0x100f00f00f00f00f), (4, 0x10c30c30c30c30c3),
+                        (2, 0x1249249249249249)):
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+    return values
+
+
+def _gridCodes(grid):
+    """
+    Interleave (n, 3) integer grid coordinates into Morton codes.
+
+    Parameters:
+    - grid (numpy.ndarray): (n, 3) coordinates from 0 to 2^21 - 1
+
+    Returns:
+    - numpy.ndarray: (n,) uint64 codes
+    """
+    grid = grid.astype(np.uint64)
+    return (_spreadBits(grid[:, 0]) << np.uint64(2)) | \
+        (_spreadBits(grid[:, 1]) << np.uint64(1)) | _spreadBits(grid[:, 2])
+
+
+def _toGrid(points, origin, cell):
+    """
+    Get the grid coordinates of points, clamped to the grid.
+
+    Parameters:
+    - points (numpy.ndarray): (n, 3) array of points
+    - origin (array like): Corner of the grid
+    - cell (float): Edge length of the grid cells
+
+    Returns:
+    - numpy.ndarray: (n, 3) int64 coordinates
+    """
+    grid = np.floor((np.asarray(points, dtype=np.float64) -
+                     np.asarray(origin)) / cell)
+    return np.clip(grid, 0, 2**_bits - 1).astype(np.int64)
+
+
+def _boxRanges(grid_min, grid_max, max_ranges):
+    """
+    Cover a box of the grid with ranges of Morton codes.
+
+    Starting from the whole grid, cells partly inside the box are split
+    into their 8 children until splitting would pass max_ranges, cells
+    fully inside are a range of their own.
+
+    Parameters:
+    - grid_min (numpy.ndarray): Smallest corner of the box on the grid
+    - grid_max (numpy.ndarray): Largest corner of the box on the grid
+    - max_ranges (int): Most ranges to split the box into
+
+    Returns:
+    - numpy.ndarray: (m, 2) uint64 inclusive code ranges, sorted
+    """
+    children = np.array([(x, y, z) for x in (0, 1)
+                         for y in (0, 1) for z in (0, 1)], dtype=np.int64)
+    cells = np.zeros((1, 3), dtype=np.int64)
+    level = _bits
+    ranges = []
+    while True:
+        size = 2**level
+        low = cells * size
+        high = low + size - 1
+        overlaps = np.all((low <= grid_max) & (high >= grid_min), axis=1)
+        inside = np.all((low >= grid_min) & (high <= grid_max), axis=1)
+        full = cells[overlaps & inside]
+        cells = cells[overlaps & ~inside]
+        ranges.append((full, level))
+        if level == 0 or len(cells) == 0 or \
+           len(cells) * 8 + sum(len(r[0]) for r in ranges) > max_ranges:
+            ranges.append((cells, level))
+            break
+        cells = (cells[:, None, :] * 2 + children).reshape(-1, 3)
+        level -= 1
+    starts = []
+    ends = []
+    for cells, level in ranges:
+        codes = _gridCodes(cells) << np.uint64(3 * level)
+        starts.append(codes)
+        ends.append(codes + np.uint64(8**level - 1))
+    starts = np.concatenate(starts)
+    order = np.argsort(starts)
+    return np.stack((starts[order], np.concatenate(ends)[order]), axis=1)
+
+
+def mortonCodes(points, origin=None, cell=None):
+    """
+    Compute the Morton code of every point.
+
+    Parameters:
+    - points (numpy.ndarray): (n, 3) array of points
+    - origin (array like, optional): Corner of the grid, defaults to the
+      smallest coordinates of the points
+    - cell (float, optional): Edge length of the grid cells, defaults to
+      the finest cell that fits the points in 21 bits per axis
+
+    Returns:
+    - numpy.ndarray: (n,) uint64 codes
+    - numpy.ndarray: (3,) origin
+    - float: cell
+    """
+    points = np.asarray(points, dtype=np.float32)
+    if origin is None:
+        origin = points.min(axis=0) if len(points) > 0 else np.zeros(3)
+    origin = np.asarray(origin, dtype=np.float64)
+    if cell is None:
+        extent = float((points.max(axis=0) - origin).max()) \
+            if len(points) > 0 else 0.0
+        cell = max(extent, 1e-6) / (2**_bits - 1)
+    return _gridCodes(_toGrid(points, origin, cell)), origin, cell
+
+
+def mortonOrder(points, block_points=4096):
+    """
+    Sort points by their Morton code and index the blocks of the order.
+
+    Parameters:
+    - points (numpy.ndarray): (n, 3) array of points
+    - block_points (int): Points per block of the index
+
+    Returns:
+    - numpy.ndarray: (n, 3) float32 points in Morton order
+    - dict: the index without offsets, see writeMortonIndex
+    """
+    points = np.asarray(points, dtype=np.float32)
+    codes, origin, cell = mortonCodes(points)
+    order = np.argsort(codes, kind="stable")
+    codes = codes[order]
+    starts = np.arange(0, len(points), block_points)
+    ends = np.minimum(starts + block_points, len(points)) - 1
+    index = {"origin": origin.tolist(),
+             "cell": cell,
+             "block_points": block_points,
+             "points": len(points),
+             "firsts": codes[starts].tolist(),
+             "lasts": codes[ends].tolist()}
+    return points[order], index
+
+
+def writeMortonIndex(ply_path, index):
+    """
+    Find the byte offset of every block in a PLY file and save the index.
+
+    Parameters:
+    - ply_path (str): ASCII or binary little endian PLY file of the
+      points in Morton order
+    - index (dict): Index from mortonOrder
+
+    Returns:
+    - str: path to the index
+    """
+    with open(ply_path, "rb") as file:
+        data = file.read()
+    header_end = data.index(b"end_header\n") + len(b"end_header\n")
+    block_starts = np.arange(0, index["points"], index["block_points"])
+    if b"format ascii" in data[:header_end]:
+        newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8,
+                                                offset=header_end) == 10)
+        line_starts = np.concatenate(([0], newlines[:-1] + 1)) + header_end
+        offsets = line_starts[block_starts].tolist()
+        index = dict(index, format="ascii")
+    else:
+        offsets = (header_end + block_starts * 12).tolist()
+        index = dict(index, format="binary")
+    index["offsets"] = offsets + [len(data)]
+    path = ply_path + _index_suffix
+    with open(path, "w") as file:
+        json.dump(index, file)
+    return path
+
+
+def readMortonIndex(ply_path):
+    """
+    Read the Morton index of a PLY file.
+
+    Parameters:
+    - ply_path (str): The PLY file
+
+    Returns:
+    - dict: the index, with codes and offsets as numpy arrays
+    """
+    with open(ply_path + _index_suffix) as file:
+        index = json.load(file)
+    for key in ("firsts", "lasts"):
+        index[key] = np.array(index[key], dtype=np.uint64)
+    index["offsets"] = np.array(index["offsets"], dtype=np.int64)
+    return index
+
+
+def queryBox(ply_path, box_min, box_max, index=None, max_ranges=64):
+    """
+    Read the points of a Morton ordered PLY file inside a box.
+
+    The box is split into a few code ranges, each found by a binary
+    search over the blocks and read as one contiguous range.
+
+    Parameters:
+    - ply_path (str): The PLY file, indexed by writeMortonIndex
+    - box_min (array like): Smallest corner of the box
+    - box_max (array like): Largest corner of the box
+    - index (dict, optional): Index from readMortonIndex, read from
+      disk if not given
+    - max_ranges (int): Most code ranges the box is split into, more
+      ranges read fewer points outside the box
+
+    Returns:
+    - numpy.ndarray: (n, 3) float32 points inside the box, inclusive
+    """
+    if index is None:
+        index = readMortonIndex(ply_path)
+    box_min = np.asarray(box_min, dtype=np.float32)
+    box_max = np.asarray(box_max, dtype=np.float32)
+    empty = np.empty((0, 3), dtype=np.float32)
+    if index["points"] == 0 or np.any(box_max < box_min):
+        return empty
+    grid_min, grid_max = _toGrid(np.stack((box_min, box_max)),
+                                 index["origin"], index["cell"])
+    ranges = _boxRanges(grid_min, grid_max, max_ranges)
+    # blocks holding each code range, merged where they touch
+    firsts = np.searchsorted(index["lasts"], ranges[:, 0], side="left")
+    lasts = np.searchsorted(index["firsts"], ranges[:, 1], side="right")
+    spans = []
+    for first, last in zip(firsts.tolist(), lasts.tolist()):
+        if last <= first:
+            continue
+        if len(spans) > 0 and first <= spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], last)
+        else:
+            spans.append([first, last])
+    if len(spans) == 0:
+        return empty
+    chunks = []
+    with open(ply_path, "rb") as file:
+        for first, last in spans:
+            start, stop = index["offsets"][first], index["offsets"][last]
+            file.seek(start)
+            chunks.append(file.read(stop - start))
+    data = b"".join(chunks)
+    if index["format"] == "ascii":
+        points = np.array(data.split(), dtype=np.float32).reshape(-1, 3)
+    else:
+        points = np.frombuffer(data, dtype="<f4").reshape(-1, 3)
+    inside = np.all((points >= box_min) & (points <= box_max), axis=1)
+    return points[inside]
+
+
+if __name__ == "__main__":
+    import os
+    import sys
+    import tempfile
+    import time
+    import zlib
+    from conversions.tiff_to_ply import extractPoints
+    from utils import readPathForFiles
+
+    source = sys.argv[1]
+    side = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+    images = readPathForFiles(source, [".tif", ".tiff"], (side, side))
+    points = extractPoints(images)
+    start = time.perf_counter()
+    ordered, index = mortonOrder(points)
+    print(f"{len(points)} points, "
+          f"morton sort {time.perf_counter() - start:.3f}s")
+
+    for name, cloud in (("lexicographic", points), ("morton", ordered)):
+        raw = cloud.astype("<f4").tobytes()
+        # differences of neighbouring grid coordinates, byte planes apart
+        grid = _toGrid(cloud, index["origin"], index["cell"])
+        deltas = np.diff(grid, axis=0, prepend=0).astype("<i4")
+        planes = deltas.view(np.uint8).reshape(-1, 12).T.tobytes()
+        print(f"{name}: zlib {len(zlib.compress(raw)) / len(raw):.1%}, "
+              f"delta zlib {len(zlib.compress(planes)) / len(raw):.1%} "
+              f"of {len(raw)} bytes")
+
+    with tempfile.TemporaryDirectory() as directory:
+        lexicographic_path = os.path.join(directory, "lexicographic.bin")
+        points.astype("<f4").tofile(lexicographic_path)
+        morton_path = os.path.join(directory, "morton.ply")
+        with open(morton_path, "wb") as file:
+            file.write(b"ply\nformat binary_little_endian 1.0\n"
+                       b"element vertex %d\nproperty float32 x\n"
+                       b"property float32 y\nproperty float32 z\n"
+                       b"end_header\n" % len(ordered))
+            file.write(ordered.astype("<f4").tobytes())
+        writeMortonIndex(morton_path, index)
+        morton_index = readMortonIndex(morton_path)
+
+        rng = np.random.default_rng(0)
+        low, high = points.min(axis=0), points.max(axis=0)
+        for fraction in (0.05, 0.1, 0.25):
+            sizes = (high - low) * fraction
+            corners = low + rng.random((100, 3)) * (high - low - sizes)
+            lexicographic_time = morton_time = 0.0
+            for corner in corners:
+                # the lexicographic order can only narrow x
+                start = time.perf_counter()
+                cloud = np.memmap(lexicographic_path, dtype="<f4",
+                                  mode="r").reshape(-1, 3)
+                lo = np.searchsorted(cloud[:, 0], corner[0], side="left")
+                hi = np.searchsorted(cloud[:, 0], corner[0] + sizes[0],
+                                     side="right")
+                candidates = np.array(cloud[lo:hi])
+                expected = candidates[np.all(
+                    (candidates >= corner) &
+                    (candidates <= corner + sizes), axis=1)]
+                lexicographic_time += time.perf_counter() - start
+                start = time.perf_counter()
+                found = queryBox(morton_path, corner, corner + sizes,
+                                 morton_index)
+                morton_time += time.perf_counter() - start
+                assert len(found) == len(expected)
+            print(f"box {fraction:.0%} of each axis: "
+                  f"lexicographic {lexicographic_time * 10:.2f} ms, "
+                  f"morton {morton_time * 10:.2f} ms")
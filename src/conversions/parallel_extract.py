@@ -0,0 +1,140 @@
+"""
+Extract points from a stack using a pool of processes.
+
+The stack is placed in shared memory once and every process extracts a
+chunk of slices from it without copying the images.
+
+Benchmark the scaling with (from src):
+    python -m conversions.parallel_extract <stack> [size] [max workers]
+
+Exported functions extractPointsParallel
+Private functions begin with an _
+"""
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import os
+import numpy as np
+from conversions.tiff_to_ply import (createMask, extractPoints, slicePoints,
+                                     sliceDepth)
+
+
+def _chunkRanges(start, stop, num_chunks):
+    """
+    Split the range [start, stop) into contiguous chunks.
+
+    Parameters:
+    - start (int): First index
+    - stop (int): One past the last index
+    - num_chunks (int): Number of chunks to split into
+
+    Returns:
+    - list of (int, int): start and stop of every non empty chunk
+    """
+    bounds = np.linspace(start, stop, num_chunks + 1).astype(int)
+    return [(int(low), int(high))
+            for low, high in zip(bounds[:-1], bounds[1:]) if high > low]
+
+
+def _extractChunk(shm_name, shape, start, stop, threshold):
+    """
+    Extract the points of slices [start, stop) from the shared volume.
+
+    The masks of slices start - 1 and stop are made as well since the
+    points of a slice depend on its neighbours.
+
+    Parameters:
+    - shm_name (str): Name of the shared memory block with the volume
+    - shape (tuple): (depth, height, width) of the volume
+    - start (int): First slice of the chunk
+    - stop (int): One past the last slice of the chunk
+    - threshold (int): Highest intensity kept in the masks
+
+    Returns:
+    - numpy.ndarray: (n, 3) float32 array of points, in slice order
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        volume = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        masks = [createMask(volume[index], threshold)
+                 for index in range(start - 1, stop + 1)]
+        del volume
+    finally:
+        shm.close()
+
+    points = [np.empty((0, 3), dtype=np.float32)]
+    for index in range(start, stop):
+        offset = index - start + 1
+        points.append(slicePoints(masks[offset - 1], masks[offset],
+                                  masks[offset + 1], sliceDepth(index)))
+    return np.concatenate(points)
+
+
+def extractPointsParallel(images, workers=None, threshold=None):
+    """
+    Convert a stack of images to a point cloud using several processes.
+
+    Gives the same points as extractPoints.
+
+    Parameters:
+    - images (list of numpy.ndarray): Grayscale slices of the same size
+    - workers (int, optional): Number of processes, defaults to the
+        number of cpus
+    - threshold (int, optional): Highest intensity kept in the masks,
+        see createMask
+
+    Returns:
+    - numpy.ndarray: (n, 3) float32 array of unique points
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    depth = len(images)
+    if workers <= 1 or depth < 4:
+        return extractPoints(images, threshold)
+    shape = (depth,) + images[0].shape
+
+    shm = shared_memory.SharedMemory(create=True,
+                                     size=int(np.prod(shape)))
+    try:
+        volume = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        for index, image in enumerate(images):
+            volume[index] = image
+        del volume
+
+        # a few chunks per worker so uneven slices balance out
+        chunks = _chunkRanges(1, depth - 1, workers * 4)
+        with ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(_extractChunk, shm.name, shape,
+                                   start, stop, threshold)
+                       for start, stop in chunks]
+            points = [future.result() for future in futures]
+    finally:
+        shm.close()
+        shm.unlink()
+
+    # every slice is in exactly one chunk, but sort like extractPoints
+    return np.unique(np.concatenate(points), axis=0)
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+    from utils import readPathForFiles
+
+    source = sys.argv[1]
+    side = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+    max_workers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+    images = readPathForFiles(source, [".tif", ".tiff"], (side, side))
+
+    start = time.perf_counter()
+    serial = extractPoints(images)
+    serial_time = time.perf_counter() - start
+    print(f"serial: {serial_time:.3f}s, {len(serial)} points")
+    workers = 1
+    while workers <= max_workers:
+        start = time.perf_counter()
+        parallel = extractPointsParallel(images, workers)
+        elapsed = time.perf_counter() - start
+        print(f"{workers} workers: {elapsed:.3f}s, "
+              f"speedup {serial_time / elapsed:.2f}, "
+              f"matches serial: {np.array_equal(serial, parallel)}")
+        workers *= 2
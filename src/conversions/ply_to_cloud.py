@@ -2,36 +2,42 @@
 
 import numpy as np
 from plyfile import PlyData
-from __main__ import ti
+from conversions.field_arena import FieldArena
 
-def readPly(fn):
+
+def readPlyPoints(fn):
     """
-    Take a file name and returns a taichi.Vector.field point cloud.
+    Take a file name and returns the vertices as an array.
 
     Parameters:
     - fn (str): File to read
 
     Returns:
-    - taichi.Vector.field: point cloud
+    - numpy.ndarray: (n, 3) float32 array of points
     """
-    @ti.kernel
-    def create_point_vert(x: ti.types.ndarray(),
-                          y: ti.types.ndarray(),
-                          z: ti.types.ndarray(),
-                          length: ti.i32):
-        for i in range(length):
-            points[i] = ti.Vector([x[i], y[i], z[i]])
-
     plydata = PlyData.read(fn)
     # perform a check here if it has faces
     vertices = plydata['vertex']
-    x = np.array(vertices['x'])
-    y = np.array(vertices['y'])
-    z = np.array(vertices['z'])
-    number_vert = len(x)
-    points = ti.Vector.field(3, dtype=ti.f32, shape=(number_vert,))
-    # points = ti.Vector.field(3, dtype=ti.f32, shape=(number_vert, ))
-    # points = ti.Matrix.field(n=3, m=number_vert, dtype=ti.f32)
-    create_point_vert(x, y, z, number_vert)
-
-    return points
\ No newline at end of file
+    return np.column_stack((vertices['x'],
+                            vertices['y'],
+                            vertices['z'])).astype(np.float32)
+
+
+def readPly(fn, arena=None):
+    """
+    Take a file name and loads the point cloud into a field arena.
+
+    Parameters:
+    - fn (str): File to read
+    - arena (FieldArena, optional): Arena to reuse, when reloading
+      clouds this avoids allocating a new field every time
+
+    Returns:
+    - FieldArena: arena whose field holds the point cloud
+      in its first count entries
+    """
+    points = readPlyPoints(fn)
+    if arena is None:
+        arena = FieldArena(len(points))
+    arena.load(points)
+    return arena
@@ -0,0 +1,83 @@
+"""
+A growable buffer of points shared between an extractor and a viewer.
+
+Exported classes PointStream
+"""
+import threading
+import numpy as np
+
+
+class PointStream():
+    """
+    Points published slice by slice while a stack is being extracted.
+
+    The extractor appends the points of every slice as they are done,
+    readers poll for the points added since they last looked.
+    """
+
+    def __init__(self, total_slices, capacity=1024):
+        """
+        Initialize an empty stream.
+
+        Parameters:
+        - total_slices (int): Number of slices that will be published
+        - capacity (int): Number of points to allocate room for
+
+        Returns:
+        - A new point stream
+        """
+        self._lock = threading.Lock()
+        self._buffer = np.empty((max(capacity, 1), 3), dtype=np.float32)
+        self.count = 0
+        self.slices_done = 0
+        self.total_slices = total_slices
+        self.done = False
+
+    def append(self, points):
+        """
+        Publish the points of one slice.
+
+        Parameters:
+        - points (numpy.ndarray): (n, 3) array of points
+        """
+        with self._lock:
+            needed = self.count + len(points)
+            if needed > len(self._buffer):
+                capacity = len(self._buffer)
+                while capacity < needed:
+                    capacity *= 2
+                buffer = np.empty((capacity, 3), dtype=np.float32)
+                buffer[:self.count] = self._buffer[:self.count]
+                self._buffer = buffer
+            self._buffer[self.count:needed] = points
+            self.count = needed
+            self.slices_done += 1
+
+    def finish(self):
+        """Mark that every slice has been published."""
+        with self._lock:
+            self.done = True
+
+    def read(self, start=0):
+        """
+        Get the points published from index start onward.
+
+        Parameters:
+        - start (int): Number of points the reader already has
+
+        Returns:
+        - numpy.ndarray: (n, 3) float32 copy of the new points
+        """
+        with self._lock:
+            return self._buffer[start:self.count].copy()
+
+    def progress(self):
+        """
+        Get the fraction of slices published.
+
+        Returns:
+        - float: between 0 and 1
+        """
+        if self.total_slices <= 0:
+            return 1.0
+        return self.slices_done / self.total_slices
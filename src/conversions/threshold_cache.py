@@ -0,0 +1,123 @@
+"""
+Cache of slices, histograms and points for retuning the mask threshold.
+
+Exported classes ThresholdCache
+Private functions begin with an _
+"""
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from conversions.tiff_to_ply import createMask, slicePoints, sliceDepth
+
+
+class ThresholdCache():
+    """
+    Keep the decoded slices of a stack so the threshold can be changed.
+
+    Each slice's cumulative histogram tells whether a threshold change
+    alters its mask, so only slices whose mask or neighbouring masks
+    changed get their points extracted again.
+    """
+
+    def __init__(self, images, threshold=None, workers=None):
+        """
+        Initialize the cache and extract the points for threshold.
+
+        Parameters:
+        - images (list of numpy.ndarray): Grayscale slices
+        - threshold (int, optional): Highest intensity kept in the masks,
+          defaults to the image height like createMask
+        - workers (int, optional): Threads used to extract slices
+
+        Returns:
+        - A new threshold cache
+        """
+        self._images = images
+        if threshold is None:
+            threshold = images[0].shape[0]
+        self.threshold = threshold
+        # number of pixels at or below each intensity for every slice
+        self._cumulative = [np.cumsum(np.bincount(image.ravel(),
+                                                  minlength=256))
+                            for image in images]
+        self._masks = [createMask(image, threshold) for image in images]
+        self._points = [None] * len(images)
+        self._pool = ThreadPoolExecutor(workers)
+        self._extract(range(1, len(images) - 1))
+
+    def setThreshold(self, threshold):
+        """
+        Change the threshold, extracting only the affected slices again.
+
+        Parameters:
+        - threshold (int): Highest intensity kept in the masks
+
+        Returns:
+        - numpy.ndarray: (n, 3) float32 array of points
+        """
+        changed = [index for index in range(len(self._images))
+                   if self._countBetween(index, self.threshold, threshold)]
+        self.threshold = threshold
+        for index in changed:
+            self._masks[index] = createMask(self._images[index], threshold)
+
+        # a slice's points depend on its masks and its neighbours' masks
+        affected = set()
+        for index in changed:
+            affected.update(range(max(index - 1, 1),
+                                  min(index + 2, len(self._images) - 1)))
+        self._extract(sorted(affected))
+        return self.points()
+
+    def points(self):
+        """
+        Get the points for the current threshold.
+
+        Returns:
+        - numpy.ndarray: (n, 3) float32 array of points
+        """
+        # every slice has its own depth, so they share no duplicates
+        slices = [points for points in self._points if points is not None]
+        if len(slices) == 0:
+            return np.empty((0, 3), dtype=np.float32)
+        return np.concatenate(slices)
+
+    def close(self):
+        """Stop the extraction threads."""
+        self._pool.shutdown()
+
+    def _countBetween(self, index, low, high):
+        """
+        Count the pixels of a slice that lie between two thresholds.
+
+        Parameters:
+        - index (int): The slice
+        - low (int): One threshold, pixels equal to it aren't counted
+        - high (int): The other threshold
+
+        Returns:
+        - int: number of pixels whose mask value differs
+        """
+        cumulative = self._cumulative[index]
+
+        def atOrBelow(threshold):
+            if threshold < 0:
+                return 0
+            return cumulative[min(threshold, 255)]
+
+        low, high = sorted((low, high))
+        return atOrBelow(high) - atOrBelow(low)
+
+    def _extract(self, indices):
+        """
+        Extract the points of the given slices in parallel.
+
+        Parameters:
+        - indices (iterable of int): Slices to extract, each must have
+          a slice before and after it
+        """
+        def extract(index):
+            self._points[index] = slicePoints(self._masks[index - 1],
+                                              self._masks[index],
+                                              self._masks[index + 1],
+                                              sliceDepth(index))
+        list(self._pool.map(extract, indices))
@@ -1,12 +1,17 @@
 """
 Converts tiff imaages in a dir or stacked in a single file to a ply file.
 
-Exported functions tiffToPly
+Exported functions tiffToPly, extractPoints, streamPoints, slicePoints,
+createMask, sliceDepth
 Private functions begin with an _
 """
 import cv2
 import numpy as np
 
+# tweakables
+SLICE_THICKNESS = 0.2  # distance between slices
+XY_SCALE = 1  # rescale of xy distance
+
 
 def _createPlyFile(filename, arr):
     """
@@ -44,92 +49,169 @@ def _createPlyFile(filename, arr):
     return filename
 
 
-def _addPoints_(mask, points_list, depth):
+def createMask(image, threshold=None):
     """
-    Add points from a mask to a list of points.
+    Create the mask of an image's pixels at or below the threshold.
 
     Parameters:
-    - mask (numpy.ndarray): The mask array containing points to be added.
-    - points_list (list): The list to which the points will be appended.
-    - depth (float or int): The depth value to assign to the points.
+    - image (numpy.ndarray): Grayscale image
+    - threshold (int, optional): Highest intensity kept in the mask,
+        defaults to the image height
 
     Returns:
-    None
+    - numpy.ndarray: mask with 255 for kept pixels and 0 elsewhere
     """
-    mask_points = np.where(mask == 255)
-    for ind in range(len(mask_points[0])):
-        # get point
-        x = mask_points[1][ind]
-        y = mask_points[0][ind]
-        point = [x, y, depth]
-        points_list.append(point)
+    if threshold is None:
+        threshold = image.shape[0]
+    return cv2.inRange(image, 0, threshold)
 
 
-def tiffToPly(images, output_name):
+def slicePoints(prev, curr, after, depth):
     """
-    Convert TIFF image(s) to a point cloud in PLY format.
+    Get the points of a slice given the masks of it and its neighbours.
+
+    A point is kept if it is in the current mask and not in the
+    previous or next one, or if it is on a contour of the current mask.
 
     Parameters:
-    - path (str): Path to the TIFF image(s) or directory
-        containing TIFF images.
-    - output_name (str): Name of the output PLY file.
+    - prev (numpy.ndarray): Mask of the previous slice
+    - curr (numpy.ndarray): Mask of the slice
+    - after (numpy.ndarray): Mask of the next slice
+    - depth (float): The depth value to assign to the points
 
     Returns:
-    - str: Path to the created PLY file.
+    - numpy.ndarray: (n, 3) float32 array of unique points
+    """
+    # points uncovered by the previous or next slice
+    edge = (curr == 255) & ((prev == 0) | (after == 0))
+    ys, xs = np.nonzero(edge)
+
+    # get contour points (_, contours) in OpenCV 2.* or 4.*
+    contours = cv2.findContours(
+        curr, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)[0]
+    if len(contours) > 0:
+        # contours have an extra layer of brackets
+        contour_points = np.concatenate(contours).reshape(-1, 2)
+        xs = np.concatenate((xs, contour_points[:, 0]))
+        ys = np.concatenate((ys, contour_points[:, 1]))
+
+    points = np.empty((len(xs), 3), dtype=np.float32)
+    points[:, 0] = xs * XY_SCALE
+    points[:, 1] = ys * XY_SCALE
+    points[:, 2] = depth
+    return np.unique(points, axis=0)
+
+
+def sliceDepth(index):
     """
-    # tweakables
-    slice_thickness = 0.2  # distance between slices
-    xy_scale = 1  # rescale of xy distance
+    Get the depth of the points of a slice.
 
+    Parameters:
+    - index (int): Index of the slice in the stack, the first slice
+        with points is 1
+
+    Returns:
+    - float: depth of the slice
+    """
+    return (index - 1) * SLICE_THICKNESS
+
+
+def extractPoints(images, threshold=None):
+    """
+    Convert a stack of images to a point cloud.
+
+    Parameters:
+    - images (list of numpy.ndarray): Grayscale slices
+    - threshold (int, optional): Highest intensity kept in the masks,
+        see createMask
+
+    Returns:
+    - numpy.ndarray: (n, 3) float32 array of unique points
+    """
     # create masks
-    masks = []
-    for image in images:
-        mask = cv2.inRange(image, 0, image.shape[0])
-        masks.append(mask)
+    masks = [createMask(image, threshold) for image in images]
 
     # go through and get points
-    depth = 0
-    points = []
+    points = [np.empty((0, 3), dtype=np.float32)]
     for index in range(1, len(masks) - 1):
-        # get three masks
-        prev = masks[index - 1]
-        curr = masks[index]
-        after = masks[index + 1]
-
-        # do a slice on previous
-        prev_mask = np.zeros_like(curr)
-        prev_mask[prev == 0] = curr[prev == 0]
-        _addPoints_(prev_mask, points, depth)
-
-        # # do a slice on after
-        next_mask = np.zeros_like(curr)
-        next_mask[after == 0] = curr[after == 0]
-        _addPoints_(next_mask, points, depth)
-
-        # get contour points (_, contours) in OpenCV 2.* or 4.*
-        contours = cv2.findContours(
-            curr, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)[0]
-        for con in contours:
-            for point in con:
-                p = point[0]  # contours have an extra layer of brackets
-                points.append([p[0], p[1], depth])
-
-        # increment depth
-        depth += slice_thickness
-
-    # rescale x,y points
-    for ind in range(len(points)):
-        # unpack
-        x, y, z = points[ind]
-
-        # scale
-        x *= xy_scale
-        y *= xy_scale
-        points[ind] = [x, y, z]
-
-    # convert points to numpy and dump duplicates
-    points = np.array(points).astype(np.float32)
-    points = np.unique(points.reshape(-1, points.shape[-1]), axis=0)
-
-    # save to point cloud file
-    return _createPlyFile(output_name, points)
+        points.append(slicePoints(masks[index - 1], masks[index],
+                                  masks[index + 1], sliceDepth(index)))
+
+    # dump duplicates and sort the points
+    return np.unique(np.concatenate(points), axis=0)
+
+
+def streamPoints(images, stream, threshold=None, output_name=None):
+    """
+    Publish the points of a stack to a stream one slice at a time.
+
+    Slices are taken from images as they are needed, so with a
+    generator like the one from utils.iterPathForFiles a slice is
+    published as soon as the slice after it is decoded, without
+    waiting on the rest of the stack.
+
+    Parameters:
+    - images (iterable of numpy.ndarray): Grayscale slices, in order
+    - stream (PointStream): Stream to publish to, finished at the end
+    - threshold (int, optional): Highest intensity kept in the masks,
+        see createMask
+    - output_name (str, optional): PLY file to write once every slice
+        is done
+
+    Returns:
+    - None
+    """
+    try:
+        prev = curr = None
+        for index, image in enumerate(images):
+            after = createMask(image, threshold)
+            if index >= 2:
+                stream.append(slicePoints(prev, curr, after,
+                                          sliceDepth(index - 1)))
+            prev, curr = curr, after
+    finally:
+        # the viewer stops waiting even if a slice couldn't be read
+        stream.finish()
+
+    if output_name is not None:
+        # every slice has its own depth, so there are no duplicates
+        _createPlyFile(output_name, np.unique(stream.read(), axis=0))
+
+
+def tiffToPly(images, output_name, threshold=None, workers=1,
+              decimation=None, morton_order=False):
+    """
+    Convert TIFF image(s) to a point cloud in PLY format.
+
+    Parameters:
+    - path (str): Path to the TIFF image(s) or directory
+        containing TIFF images.
+    - output_name (str): Name of the output PLY file.
+    - threshold (int, optional): Highest intensity kept in the masks,
+        see createMask
+    - workers (int, optional): Number of processes extracting points,
+        None uses every cpu
+    - decimation (Decimation, optional): Stage reducing the points
+        before they are written
+    - morton_order (bool, optional): Write the points in Morton order
+        with an index for box queries, see conversions.morton
+
+    Returns:
+    - str: Path to the created PLY file.
+    """
+    if workers == 1:
+        points = extractPoints(images, threshold)
+    else:
+        from conversions.parallel_extract import extractPointsParallel
+        points = extractPointsParallel(images, workers, threshold)
+    if decimation is not None:
+        points = decimation(points)
+    if not morton_order:
+        # save to point cloud file
+        return _createPlyFile(output_name, points)
+
+    from conversions.morton import mortonOrder, writeMortonIndex
+    points, index = mortonOrder(points)
+    _createPlyFile(output_name, points)
+    writeMortonIndex(output_name, index)
+    return output_name
@@ -0,0 +1,190 @@
+"""
+Write point clouds as spatial tiles on disk at several levels of detail.
+
+Level 0 of a tile holds all of its points, every level after it holds
+a random quarter of the level before, so far away tiles can be drawn
+with few points. Points are streamed to disk as they are added so the
+whole cloud never has to fit in memory.
+
+Layout of the output directory:
+    - index.json: tile size, number of levels and every tile's bounds
+      and point counts per level
+    - <level>_<ix>_<iy>_<iz>.bin: float32 xyz points of a tile
+
+Exported classes TiledCloudWriter
+Exported functions tileStack, readTileIndex, tilePath
+Private functions begin with an _
+"""
+import json
+import os
+import numpy as np
+from conversions.tiff_to_ply import createMask, slicePoints, sliceDepth
+
+_index_name = "index.json"
+
+
+def tilePath(tile_dir, level, key):
+    """
+    Get the file holding a level of a tile.
+
+    Parameters:
+    - tile_dir (str): Directory of the tiled cloud
+    - level (int): Level of detail, 0 is the full resolution
+    - key (tuple of int): Index of the tile
+
+    Returns:
+    - str: path to the file
+    """
+    return os.path.join(tile_dir, f"{level}_{key[0]}_{key[1]}_{key[2]}.bin")
+
+
+def readTileIndex(tile_dir):
+    """
+    Read the index of a tiled cloud.
+
+    Parameters:
+    - tile_dir (str): Directory of the tiled cloud
+
+    Returns:
+    - dict: the index, with tile keys as tuples
+    """
+    with open(os.path.join(tile_dir, _index_name)) as file:
+        index = json.load(file)
+    for tile in index["tiles"]:
+        tile["key"] = tuple(tile["key"])
+    return index
+
+
+class TiledCloudWriter():
+    """Bin points into tiles and append them to the tile files."""
+
+    def __init__(self, tile_dir, tile_size=64.0, levels=4,
+                 buffer_bytes=64 * 2**20, seed=None):
+        """
+        Initialize a writer to an empty directory.
+
+        Parameters:
+        - tile_dir (str): Directory to write the tiles to
+        - tile_size (float): Edge length of the cubic tiles
+        - levels (int): Number of levels of detail
+        - buffer_bytes (int): Points held in memory before they
+          are appended to the tile files
+        - seed (int, optional): Seed for picking the coarser levels
+
+        Returns:
+        - A new writer
+        """
+        os.makedirs(tile_dir, exist_ok=True)
+        self._tile_dir = tile_dir
+        self._tile_size = tile_size
+        self._levels = levels
+        self._buffer_bytes = buffer_bytes
+        self._rng = np.random.default_rng(seed)
+        # (level, key) to list of arrays waiting to be written
+        self._buffers = {}
+        self._buffered = 0
+        # key to [min, max, counts per level]
+        self._tiles = {}
+
+    def add(self, points):
+        """
+        Add points to the tiles.
+
+        Parameters:
+        - points (numpy.ndarray): (n, 3) array of points
+        """
+        points = np.asarray(points, dtype=np.float32)
+        if len(points) == 0:
+            return
+        keys = np.floor(points / self._tile_size).astype(np.int64)
+        # points are in level k if their draw is below 4^-k
+        draws = self._rng.random(len(points))
+        unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.searchsorted(inverse[order],
+                                 np.arange(len(unique_keys) + 1))
+        for tile, key in enumerate(map(tuple, unique_keys.tolist())):
+            members = order[bounds[tile]:bounds[tile + 1]]
+            tile_points = points[members]
+            tile_draws = draws[members]
+            if key not in self._tiles:
+                self._tiles[key] = [tile_points.min(axis=0),
+                                    tile_points.max(axis=0),
+                                    [0] * self._levels]
+            else:
+                info = self._tiles[key]
+                info[0] = np.minimum(info[0], tile_points.min(axis=0))
+                info[1] = np.maximum(info[1], tile_points.max(axis=0))
+            for level in range(self._levels):
+                kept = tile_points[tile_draws < 0.25 ** level]
+                if len(kept) == 0:
+                    break
+                self._buffers.setdefault((level, key), []).append(kept)
+                self._tiles[key][2][level] += len(kept)
+                self._buffered += kept.nbytes
+        if self._buffered > self._buffer_bytes:
+            self._flush()
+
+    def finish(self):
+        """
+        Write the remaining points and the index.
+
+        Returns:
+        - str: the tile directory
+        """
+        self._flush()
+        tiles = [{"key": list(key),
+                  "min": info[0].tolist(),
+                  "max": info[1].tolist(),
+                  "counts": info[2]}
+                 for key, info in sorted(self._tiles.items())]
+        index = {"tile_size": self._tile_size,
+                 "levels": self._levels,
+                 "points": sum(tile["counts"][0] for tile in tiles),
+                 "tiles": tiles}
+        with open(os.path.join(self._tile_dir, _index_name), "w") as file:
+            json.dump(index, file)
+        return self._tile_dir
+
+    def _flush(self):
+        """Append the buffered points to their tile files."""
+        for (level, key), arrays in self._buffers.items():
+            with open(tilePath(self._tile_dir, level, key), "ab") as file:
+                for array in arrays:
+                    file.write(array.tobytes())
+        self._buffers = {}
+        self._buffered = 0
+
+
+def tileStack(images, tile_dir, threshold=None, tile_size=64.0, levels=4):
+    """
+    Extract the points of a stack straight into a tiled cloud.
+
+    Only three masks and one slice of points are held at once.
+
+    Parameters:
+    - images (list of numpy.ndarray): Grayscale slices
+    - tile_dir (str): Directory to write the tiles to, existing tile
+      files in it are replaced
+    - threshold (int, optional): Highest intensity kept in the masks,
+        see createMask
+    - tile_size (float): Edge length of the cubic tiles
+    - levels (int): Number of levels of detail
+
+    Returns:
+    - str: the tile directory
+    """
+    if os.path.isdir(tile_dir):
+        for file in os.listdir(tile_dir):
+            if file.endswith(".bin") or file == _index_name:
+                os.remove(os.path.join(tile_dir, file))
+    writer = TiledCloudWriter(tile_dir, tile_size, levels)
+    if len(images) >= 3:
+        prev = createMask(images[0], threshold)
+        curr = createMask(images[1], threshold)
+        for index in range(1, len(images) - 1):
+            after = createMask(images[index + 1], threshold)
+            writer.add(slicePoints(prev, curr, after, sliceDepth(index)))
+            prev, curr = curr, after
+    return writer.finish()
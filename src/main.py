@@ -1,7 +1,9 @@
 """Entry point for renderer."""
+from conversions.decimate import Decimation
 from conversions.tiff_to_ply import tiffToPly
 from slice_viewer import view_slices
-from utils import readPathForFiles
+from utils import iterPathForFiles, listStacks, readPathForFiles, stackTag
+import os
 import tkinter as tk
 from tkinter import filedialog
 
@@ -10,6 +12,7 @@ from tkinter import filedialog
 render_with_control_ui_str = "Render Points with Control UI"
 render_with_keyboard_controls_str = "Render Points with Keyboard Controls"
 render_slices_str = "Render Slices"
+render_time_series_str = "Play Time Series"
 
 
 def ti_init():
@@ -80,6 +83,10 @@ def pickImageAndMethod(x_scale, y_scale):
         nonlocal rendering_method
         rendering_method = render_slices_str
         selected_label.configure(text=getLabel(source, rendering_method))
+    def renderTimeSeries():
+        nonlocal rendering_method
+        rendering_method = render_time_series_str
+        selected_label.configure(text=getLabel(source, rendering_method))
     def returnSelections():
         window.destroy()
 
@@ -93,6 +100,8 @@ def pickImageAndMethod(x_scale, y_scale):
     render_keyboard_controls.grid(row=1, column=1)
     render_slices = tk.Button(window, text="Render Slices", command=renderSlices)
     render_slices.grid(row=1, column=2)
+    render_time_series = tk.Button(window, text="Play Time Series", command=renderTimeSeries)
+    render_time_series.grid(row=1, column=3)
     start_button = tk.Button(window, text="Begin Rendering", command=returnSelections)
     start_button.grid(row=3, column=1)
 
@@ -108,30 +117,135 @@ if __name__ == "__main__":
     if source is None or render_method is None:
         print("Didn't select a rendering method or didn't select a target to view")
         exit()
+    # show slices at their own resolution with pan and zoom
+    pyramid_slices = False
+    # directory the slice pyramids are kept in between runs, every stack
+    # gets its own directory named by its tag, None keeps them in memory
+    pyramid_cache_dir = ".pyramid_cache"
     # returns grayscale 100 x 100 images
     size = (128 , 128)
+    if render_method == render_slices_str and pyramid_slices:
+        size = None
+    output = "mri.ply"
+    # draw a frame-time budgeted subset of points while the camera moves
+    budgeted = False
+    # only draw the points inside the camera's view, using an octree
+    culled = False
+    # highest intensity kept in the masks, None uses the image height
+    threshold = None
+    # processes used to extract points, None uses every cpu
+    workers = 1
+    # show points in the keyboard renderer while the slices are decoded
+    # and extracted, components and tiled take precedence and so do
+    # budgeted, culled, workers, decimation and morton_order away from
+    # their defaults, since they need the whole cloud extracted first
+    streamed = True
+    # write the points as tiles on disk and stream them around the camera
+    # in the keyboard renderer, for clouds that don't fit in memory
+    tiled = False
+    tile_dir = "mri_tiles"
+    # draw the performance overlay and export frame metrics on exit
+    show_hud = False
+    metrics_path = None  # e.g. "metrics.json" or "metrics.csv"
+    # reduce the points before they are written and rendered, "voxel"
+    # or "poisson" with a spacing or a target number of points, None
+    # keeps every point
+    decimation_method = None
+    decimation_spacing = None
+    decimation_target = 200000
+    decimation = None
+    if decimation_method is not None:
+        decimation = Decimation(decimation_method, decimation_spacing,
+                                decimation_target)
+    # write the points in Morton order with an index for box queries
+    morton_order = False
+    # label the connected structures so each can be shown or hidden
+    # in the keyboard renderer
+    components = False
+    # timepoints shown per second when playing a directory of stacks
+    time_series_fps = 10.0
+    global ti
+    if render_method == render_time_series_str:
+        # every stack or PLY file in the directory is one timepoint
+        sources = []
+        if os.path.isdir(source):
+            sources = list(listStacks(source, [".tif", ".tiff", ".ply"]).values())
+        if len(sources) == 0:
+            print("Error: Did not select a directory of stacks.")
+            exit()
+        ti = ti_init()
+        from visualizers.taichi import renderTimeSeries
+        renderTimeSeries(sources, size, threshold, time_series_fps,
+                         show_hud, metrics_path)
+        exit()
+    # the settings that need the whole cloud take precedence over streaming
+    streamed = streamed and not components and not tiled and \
+        not budgeted and not culled and workers == 1 and \
+        decimation is None and not morton_order
+    if render_method == render_with_keyboard_controls_str and streamed:
+        # show points while the slices are decoded and extracted on
+        # another thread, the file is written after
+        stack = iterPathForFiles(source, [".tif", ".tiff"], size)
+        if stack is None:
+            print("Error: Did not select a supported image type.")
+            exit()
+        import threading
+        from conversions.point_stream import PointStream
+        from conversions.tiff_to_ply import streamPoints
+        ti = ti_init()
+        from visualizers.taichi import renderStream
+        num_slices, slices = stack
+        stream = PointStream(max(num_slices - 2, 0))
+        threading.Thread(target=streamPoints,
+                         args=(slices, stream, threshold, output),
+                         daemon=True).start()
+        renderStream(stream, show_hud, metrics_path)
+        exit()
     images = readPathForFiles(source, [".tif", ".tiff"], size)
     if images is None:
         print("Error: Did not select a supported image type.")
         exit()
-    output = "mri.ply"
     if render_method == render_slices_str:
-        view_slices(images)
+        cache_dir = None
+        if pyramid_slices and pyramid_cache_dir is not None:
+            cache_dir = os.path.join(pyramid_cache_dir,
+                                     stackTag(source, (size, "pyramid")))
+        view_slices(images, pyramid_slices, cache_dir)
         exit()
-    global ti
     ti = ti_init()
-    tiffToPly(images, output)
+    if render_method == render_with_keyboard_controls_str and components:
+        from conversions.components import labelComponents
+        from conversions.tiff_to_ply import extractPoints
+        from visualizers.taichi import renderComponents
+        cloud = labelComponents(images, extractPoints(images, threshold),
+                                threshold)
+        renderComponents(cloud, show_hud, metrics_path)
+        exit()
+    if render_method == render_with_keyboard_controls_str and tiled:
+        from conversions.tiled_cloud import tileStack
+        from visualizers.taichi import renderTiles
+        tileStack(images, tile_dir, threshold)
+        renderTiles(tile_dir, show_hud=show_hud, metrics_path=metrics_path)
+        exit()
+    tiffToPly(images, output, threshold, workers, decimation, morton_order)
+    if decimation is not None:
+        print(decimation.describe())
 
     from conversions.ply_to_cloud import readPly
-    points = readPly(output)
+    arena = readPly(output)
     # this function contains the draw loop
     # and creation of the visualizer
     # Create a new Tkinter window
     if render_method == render_with_keyboard_controls_str:
         from visualizers.taichi import render
-        render(points)
+        render(arena.field, arena.count, budgeted, show_hud, metrics_path,
+               culled)
         exit()
     if render_method == render_with_control_ui_str:
         from ui_control import renderUI
-        renderUI(points)
+        from conversions.threshold_cache import ThresholdCache
+        threshold_cache = ThresholdCache(images, threshold)
+        renderUI(arena.field, arena.count, threshold_cache, arena,
+                 show_hud, metrics_path, decimation)
+        threshold_cache.close()
         exit()
@@ -0,0 +1,661 @@
+"""
+Serve converted stacks to the web interface over HTTP using asyncio.
+
+Routes:
+    - /stacks: json list of the stacks in the root directory, the names
+      of stack files keep their extension
+    - /stacks/<name>: json info about a stack, converting it if needed
+    - /stacks/<name>/cloud.ply: binary PLY of the point cloud
+    - /stacks/<name>/chunks/<index>: float32 xyz points of one chunk
+    - /stacks/<name>/box?min=x,y,z&max=x,y,z: float32 xyz points inside
+      a box
+    - /stacks/<name>/slices/<index>.png: thumbnail of one slice
+
+Byte ranges, ETags and HEAD requests are supported. Conversions run in
+a process pool and are cached on disk, concurrent requests for a stack
+share a single conversion. Cached points are in Morton order, so chunks
+are spatially local and boxes are read from a few contiguous ranges.
+
+Run with:
+    python src/server.py serve <stack directory> [--port 8000]
+Load test with:
+    python src/server.py load http://127.0.0.1:8000/stacks/<name>/cloud.ply
+
+Exported classes PointCloudServer
+Private functions begin with an _
+"""
+import argparse
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import json
+import multiprocessing
+import os
+import time
+from urllib.parse import parse_qs, unquote, urlsplit
+import cv2
+import numpy as np
+from conversions.morton import (mortonOrder, queryBox, readMortonIndex,
+                                writeMortonIndex)
+from conversions.tiff_to_ply import extractPoints
+from utils import listStacks, readPathForFiles, stackTag
+
+_tiff_endings = [".tif", ".tiff"]
+_reasons = {200: "OK", 206: "Partial Content", 304: "Not Modified",
+            400: "Bad Request", 404: "Not Found",
+            405: "Method Not Allowed", 416: "Range Not Satisfiable",
+            500: "Internal Server Error"}
+
+
+def _plyHeader(num_verts):
+    """
+    Create the header of a binary PLY file of points.
+
+    Parameters:
+    - num_verts (int): Number of points in the file
+
+    Returns:
+    - bytes: the header
+    """
+    return ("ply\n"
+            "format binary_little_endian 1.0\n"
+            f"element vertex {num_verts}\n"
+            "property float32 x\n"
+            "property float32 y\n"
+            "property float32 z\n"
+            "end_header\n").encode("ascii")
+
+
+def _convertStack(source, cache_dir, name, size, threshold, thumb_size):
+    """
+    Convert a stack and write the results to the cache directory.
+
+    Runs in a worker process.
+
+    Parameters:
+    - source (str): Path to the stack
+    - cache_dir (str): Directory to write the results to
+    - name (str): Name of the stack, prefix of the written files
+    - size (tuple): Size the slices are resized to before extracting
+    - threshold (int): Highest intensity kept in the masks
+    - thumb_size (tuple): Size of the slice thumbnails
+
+    Returns:
+    - dict: number of points and slices
+    """
+    images = readPathForFiles(source, _tiff_endings, size)
+    points, index = mortonOrder(extractPoints(images, threshold))
+    prefix = os.path.join(cache_dir, name)
+    with open(prefix + ".ply", "wb") as file:
+        file.write(_plyHeader(len(points)))
+        file.write(points.astype("<f4").tobytes())
+    writeMortonIndex(prefix + ".ply", index)
+    for index, image in enumerate(images):
+        ok, png = cv2.imencode(".png", cv2.resize(image, thumb_size))
+        with open(f"{prefix}.{index}.png", "wb") as file:
+            file.write(png.tobytes())
+    info = {"points": len(points), "slices": len(images)}
+    with open(prefix + ".json", "w") as file:
+        json.dump(info, file)
+    return info
+
+
+class _HttpError(Exception):
+    """An error that is sent to the client as a status code."""
+
+    def __init__(self, status, headers=None):
+        super(_HttpError, self).__init__(_reasons[status])
+        self.status = status
+        # extra headers sent with the error
+        self.headers = {} if headers is None else headers
+
+
+class _ByteLRU():
+    """A least recently used cache bounded by the bytes it holds."""
+
+    def __init__(self, max_bytes):
+        self._items = OrderedDict()
+        self._max_bytes = max_bytes
+        self.bytes = 0
+
+    def get(self, key):
+        value = self._items.get(key)
+        if value is not None:
+            self._items.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if key in self._items:
+            self.bytes -= len(self._items.pop(key))
+        if len(value) > self._max_bytes:
+            return
+        self._items[key] = value
+        self.bytes += len(value)
+        while self.bytes > self._max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self.bytes -= len(evicted)
+
+
+class PointCloudServer():
+    """Serve the stacks in a directory and their conversions."""
+
+    def __init__(self, root, cache_dir=None, size=(128, 128), threshold=None,
+                 chunk_points=65536, cache_bytes=64 * 2**20, workers=None,
+                 thumb_size=(64, 64), listing_ttl=2.0):
+        """
+        Initialize a new server.
+
+        Parameters:
+        - root (str): Directory containing tiff stacks or directories
+          of tiff slices
+        - cache_dir (str, optional): Directory for converted stacks,
+          defaults to .cache inside root
+        - size (tuple): Size slices are resized to before extracting
+        - threshold (int, optional): Highest intensity kept in the masks
+        - chunk_points (int): Number of points per chunk
+        - cache_bytes (int): Size of the in memory chunk cache
+        - workers (int, optional): Number of conversion processes
+        - thumb_size (tuple): Size of the slice thumbnails
+        - listing_ttl (float): Seconds the stacks found in root and
+          their tags are reused before root is scanned again
+
+        Returns:
+        - A new server
+        """
+        self._root = root
+        self._cache_dir = cache_dir or os.path.join(root, ".cache")
+        os.makedirs(self._cache_dir, exist_ok=True)
+        self._size = tuple(size)
+        self._threshold = threshold
+        self._chunk_points = chunk_points
+        self._thumb_size = tuple(thumb_size)
+        # forked workers would inherit and hold open client sockets
+        self._pool = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("spawn"))
+        self._chunks = _ByteLRU(cache_bytes)
+        # conversions that are running, shared by concurrent requests
+        self._pending = {}
+        self._infos = {}
+        # morton indexes of the converted stacks
+        self._morton = {}
+        # future of the latest scan of root and when it is out of date
+        self._listing = None
+        self._listing_expiry = 0.0
+        self._listing_ttl = listing_ttl
+        self.conversions = 0
+
+    async def serve(self, host="127.0.0.1", port=8000):
+        """
+        Serve forever.
+
+        Parameters:
+        - host (str): Address to bind to
+        - port (int): Port to bind to
+        """
+        server = await asyncio.start_server(self._handleClient, host, port)
+        print(f"serving {self._root} on http://{host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        """Stop the conversion processes."""
+        self._pool.shutdown()
+
+    def _stackSources(self):
+        """
+        Find the stacks in the root directory.
+
+        Returns:
+        - dict: stack name to its path
+        """
+        return listStacks(self._root, _tiff_endings)
+
+    def _scanStacks(self):
+        """
+        Find the stacks in the root directory and tag them.
+
+        Runs in a thread, statting every slice of a directory stack
+        would block the event loop.
+
+        Returns:
+        - dict: stack name to its path and tag
+        """
+        return {name: (source, self._stackTag(source))
+                for name, source in self._stackSources().items()}
+
+    async def _stackListing(self):
+        """
+        Get the stacks in the root directory and their tags.
+
+        Concurrent requests share one scan, which is reused for
+        listing_ttl seconds.
+
+        Returns:
+        - dict: stack name to its path and tag
+        """
+        now = time.monotonic()
+        if self._listing is None or now >= self._listing_expiry:
+            self._listing_expiry = now + self._listing_ttl
+            loop = asyncio.get_running_loop()
+            self._listing = loop.run_in_executor(None, self._scanStacks)
+        listing = self._listing
+        try:
+            return await asyncio.shield(listing)
+        except OSError:
+            # a stack changed during the scan, scan again next time
+            if self._listing is listing:
+                self._listing = None
+            raise
+
+    def _stackTag(self, source):
+        """
+        Get a tag that changes when the stack or the settings change.
+
+        Parameters:
+        - source (str): Path to the stack
+
+        Returns:
+        - str: the tag
+        """
+        return stackTag(source, (self._size, self._threshold,
+                                 self._thumb_size, "morton"))
+
+    async def _stack(self, name):
+        """
+        Get the info of a stack, converting it if it isn't cached.
+
+        Parameters:
+        - name (str): Name of the stack
+
+        Returns:
+        - dict: info of the stack including its tag
+        """
+        found = (await self._stackListing()).get(name)
+        if found is None:
+            raise _HttpError(404)
+        source, tag = found
+        key = f"{name}-{tag}"
+        info = self._infos.get(key)
+        if info is not None:
+            return info
+        task = self._pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._convert(source, tag, key))
+            self._pending[key] = task
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _convert(self, source, tag, key):
+        """
+        Convert a stack in the process pool unless it is on disk.
+
+        Parameters:
+        - source (str): Path to the stack
+        - tag (str): Tag of the stack, see _stackTag
+        - key (str): Name of the files in the cache directory
+
+        Returns:
+        - dict: number of points and slices, the tag and the key
+        """
+        info_path = os.path.join(self._cache_dir, key + ".json")
+        if os.path.exists(info_path):
+            with open(info_path) as file:
+                info = json.load(file)
+        else:
+            self.conversions += 1
+            loop = asyncio.get_running_loop()
+            info = await loop.run_in_executor(
+                self._pool, _convertStack, source, self._cache_dir, key,
+                self._size, self._threshold, self._thumb_size)
+        info = dict(info, tag=tag, key=key)
+        self._infos[key] = info
+        return info
+
+    async def _route(self, path, query=""):
+        """
+        Find the content of a path.
+
+        Parameters:
+        - path (str): The requested path
+        - query (str): The query string of the request
+
+        Returns:
+        - (bytes or str, str, str): the content or a file to read it
+          from, its content type and its ETag
+        """
+        parts = [unquote(part) for part in path.strip("/").split("/")]
+        if parts[0] != "stacks":
+            raise _HttpError(404)
+        if len(parts) == 1:
+            names = list(await self._stackListing())
+            return json.dumps(names).encode(), "application/json", None
+
+        info = await self._stack(parts[1])
+        prefix = os.path.join(self._cache_dir, info["key"])
+        etag = f'"{info["tag"]}-{"-".join(parts[2:]) or "info"}"'
+        if len(parts) == 2:
+            chunks = -(-info["points"] // self._chunk_points)
+            body = dict(points=info["points"], slices=info["slices"],
+                        chunk_points=self._chunk_points, chunks=chunks)
+            return json.dumps(body).encode(), "application/json", etag
+        if parts[2:] == ["cloud.ply"]:
+            return prefix + ".ply", "application/octet-stream", etag
+        if parts[2:] == ["box"]:
+            return (await self._box(info, query),
+                    "application/octet-stream", f'{etag[:-1]}-{query}"')
+        if len(parts) == 4 and parts[2] == "chunks" and parts[3].isdigit():
+            return (await self._chunk(info, int(parts[3])),
+                    "application/octet-stream", etag)
+        if len(parts) == 4 and parts[2] == "slices" and \
+           parts[3].endswith(".png") and parts[3][:-4].isdigit():
+            index = int(parts[3][:-4])
+            if index >= info["slices"]:
+                raise _HttpError(404)
+            return f"{prefix}.{index}.png", "image/png", etag
+        raise _HttpError(404)
+
+    async def _chunk(self, info, index):
+        """
+        Get the bytes of a chunk of points through the chunk cache.
+
+        Parameters:
+        - info (dict): Info of the stack
+        - index (int): Index of the chunk
+
+        Returns:
+        - bytes: float32 xyz points
+        """
+        key = (info["key"], index)
+        chunk = self._chunks.get(key)
+        if chunk is not None:
+            return chunk
+        start = index * self._chunk_points
+        if index > 0 and start >= info["points"]:
+            raise _HttpError(404)
+        count = min(self._chunk_points, info["points"] - start)
+        # points are stored after the header as 12 byte xyz triples
+        offset = len(_plyHeader(info["points"])) + start * 12
+        loop = asyncio.get_running_loop()
+        chunk = await loop.run_in_executor(
+            None, _readRange,
+            os.path.join(self._cache_dir, info["key"] + ".ply"),
+            offset, offset + count * 12)
+        self._chunks.put(key, chunk)
+        return chunk
+
+    async def _box(self, info, query):
+        """
+        Get the points of a stack inside a box.
+
+        Parameters:
+        - info (dict): Info of the stack
+        - query (str): Query string with the box corners as min=x,y,z
+          and max=x,y,z
+
+        Returns:
+        - bytes: float32 xyz points
+        """
+        fields = parse_qs(query)
+        try:
+            box_min, box_max = ([float(value) for value in
+                                 fields[corner][0].split(",")]
+                                for corner in ("min", "max"))
+        except (KeyError, ValueError):
+            raise _HttpError(400)
+        if len(box_min) != 3 or len(box_max) != 3:
+            raise _HttpError(400)
+        path = os.path.join(self._cache_dir, info["key"] + ".ply")
+        index = self._morton.get(info["key"])
+        loop = asyncio.get_running_loop()
+        if index is None:
+            index = await loop.run_in_executor(None, readMortonIndex, path)
+            self._morton[info["key"]] = index
+        points = await loop.run_in_executor(None, queryBox, path, box_min,
+                                            box_max, index)
+        return points.astype("<f4").tobytes()
+
+    async def _handleClient(self, reader, writer):
+        """
+        Answer the requests of one connection until it closes.
+
+        Parameters:
+        - reader (asyncio.StreamReader): Reads the requests
+        - writer (asyncio.StreamWriter): Writes the responses
+        """
+        try:
+            while True:
+                request = await reader.readuntil(b"\r\n\r\n")
+                keep_alive = await self._respond(request, writer)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, request, writer):
+        """
+        Write the response to a request.
+
+        Parameters:
+        - request (bytes): The request line and headers
+        - writer (asyncio.StreamWriter): Writes the response
+
+        Returns:
+        - bool: whether the connection should be kept open
+        """
+        lines = request.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ")
+        except ValueError:
+            self._writeHead(writer, 400, {"Connection": "close"})
+            return False
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                key, value = line.split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+        keep_alive = version == "HTTP/1.1" and \
+            headers.get("connection", "").lower() != "close"
+
+        try:
+            if method not in ("GET", "HEAD"):
+                raise _HttpError(405)
+            url = urlsplit(target)
+            content, content_type, etag = \
+                await self._route(url.path, url.query)
+            status, extra, content = await self._select(content, headers,
+                                                        etag)
+        except _HttpError as error:
+            body = error.args[0].encode()
+            error_headers = {"Content-Length": len(body),
+                             "Content-Type": "text/plain"}
+            error_headers.update(error.headers)
+            self._writeHead(writer, error.status, error_headers)
+            if method != "HEAD":
+                writer.write(body)
+            return keep_alive
+        except Exception as error:
+            print(f"error serving {target}: {error!r}")
+            self._writeHead(writer, 500, {"Connection": "close"})
+            return False
+
+        response_headers = {"Content-Length": len(content),
+                            "Accept-Ranges": "bytes"}
+        if content_type is not None and status != 304:
+            response_headers["Content-Type"] = content_type
+        if etag is not None:
+            response_headers["ETag"] = etag
+        response_headers.update(extra)
+        self._writeHead(writer, status, response_headers)
+        if method != "HEAD":
+            writer.write(content)
+        return keep_alive
+
+    async def _select(self, content, headers, etag):
+        """
+        Pick the part of the content the request asked for.
+
+        Parameters:
+        - content (bytes or str): The content or a file to read it from
+        - headers (dict): Lower case request headers
+        - etag (str): ETag of the content
+
+        Returns:
+        - (int, dict, bytes): status, extra headers and the body
+        """
+        if etag is not None and headers.get("if-none-match") == etag:
+            return 304, {}, b""
+        if isinstance(content, str):
+            size = os.path.getsize(content)
+        else:
+            size = len(content)
+
+        start, stop, status, extra = 0, size, 200, {}
+        byte_range = headers.get("range")
+        if_range = headers.get("if-range")
+        if byte_range is not None and (if_range is None or if_range == etag):
+            start, stop = _parseRange(byte_range, size)
+            status = 206
+            extra["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+
+        if isinstance(content, str):
+            loop = asyncio.get_running_loop()
+            content = await loop.run_in_executor(None, _readRange, content,
+                                                 start, stop)
+        else:
+            content = content[start:stop]
+        return status, extra, content
+
+    def _writeHead(self, writer, status, headers):
+        """
+        Write the status line and headers of a response.
+
+        Parameters:
+        - writer (asyncio.StreamWriter): Writes the response
+        - status (int): HTTP status code
+        - headers (dict): Response headers
+        """
+        head = [f"HTTP/1.1 {status} {_reasons[status]}"]
+        head += [f"{key}: {value}" for key, value in headers.items()]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+
+
+def _parseRange(byte_range, size):
+    """
+    Parse a single range of a Range header.
+
+    Parameters:
+    - byte_range (str): Value of the Range header
+    - size (int): Size of the content
+
+    Returns:
+    - (int, int): start and one past the end of the range
+    """
+    # a 416 names the size of the content so the client can ask again
+    unsatisfiable = {"Content-Range": f"bytes */{size}"}
+    unit, _, spec = byte_range.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        raise _HttpError(416, unsatisfiable)
+    first, _, last = spec.strip().partition("-")
+    try:
+        if first == "":
+            start, stop = max(size - int(last), 0), size
+        else:
+            start = int(first)
+            stop = size if last == "" else min(int(last) + 1, size)
+    except ValueError:
+        raise _HttpError(416, unsatisfiable)
+    if start >= size or start >= stop:
+        raise _HttpError(416, unsatisfiable)
+    return start, stop
+
+
+def _readRange(path, start, stop):
+    """
+    Read part of a file.
+
+    Parameters:
+    - path (str): File to read
+    - start (int): First byte
+    - stop (int): One past the last byte
+
+    Returns:
+    - bytes: the content
+    """
+    with open(path, "rb") as file:
+        file.seek(start)
+        return file.read(stop - start)
+
+
+async def _loadTest(url, clients, requests):
+    """
+    Request a url from many concurrent keep-alive connections.
+
+    Parameters:
+    - url (str): The url to request
+    - clients (int): Number of concurrent connections
+    - requests (int): Number of requests per connection
+
+    Returns:
+    - list of float: seconds each request took
+    """
+    parts = urlsplit(url)
+    request = (f"GET {parts.path or '/'} HTTP/1.1\r\n"
+               f"Host: {parts.netloc}\r\n\r\n").encode()
+    latencies = []
+
+    async def client():
+        reader, writer = await asyncio.open_connection(parts.hostname,
+                                                       parts.port or 80)
+        for _ in range(requests):
+            start = time.perf_counter()
+            writer.write(request)
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = 0
+            for line in head.decode("latin-1").split("\r\n"):
+                if line.lower().startswith("content-length:"):
+                    length = int(line.split(":", 1)[1])
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+        writer.close()
+
+    await asyncio.gather(*(client() for _ in range(clients)))
+    return latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve")
+    serve.add_argument("root")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8000)
+    serve.add_argument("--size", type=int, default=128)
+    serve.add_argument("--workers", type=int, default=None)
+    load = commands.add_parser("load")
+    load.add_argument("url")
+    load.add_argument("--clients", type=int, default=100)
+    load.add_argument("--requests", type=int, default=20)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        server = PointCloudServer(args.root, size=(args.size, args.size),
+                                  workers=args.workers)
+        try:
+            asyncio.run(server.serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+    else:
+        start = time.perf_counter()
+        latencies = np.array(asyncio.run(
+            _loadTest(args.url, args.clients, args.requests)))
+        elapsed = time.perf_counter() - start
+        print(f"{len(latencies)} requests in {elapsed:.2f}s, "
+              f"{len(latencies) / elapsed:.0f} requests/s, "
+              f"p50 {np.percentile(latencies, 50) * 1e3:.1f}ms, "
+              f"p99 {np.percentile(latencies, 99) * 1e3:.1f}ms")
@@ -0,0 +1,250 @@
+"""
+Multi-level tile pyramids of slices for viewing them at any zoom.
+
+Exported classes SlicePyramid, PyramidCache
+Private functions begin with an _
+"""
+from collections import deque
+import math
+import os
+import threading
+import cv2
+import numpy as np
+
+
+def _loadLevel(path, size, dtype):
+    """
+    Memory map a saved level if it is the level that would be built.
+
+    Parameters:
+    - path (str): File the level was saved to
+    - size (tuple): (width, height) of the level
+    - dtype (numpy.dtype): Type of the slice
+
+    Returns:
+    - numpy.ndarray or None: the level, None if it isn't saved, the
+      save didn't finish or it is from a slice of another size
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        level = np.load(path, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    if level.shape != (size[1], size[0]) or level.dtype != dtype:
+        return None
+    return level
+
+
+class SlicePyramid():
+    """
+    A slice at its own resolution and at every halving down to one tile.
+
+    Views are composed from the visible tiles of the level closest to
+    the zoom, so the cost of a view depends on the view size and not
+    on the resolution of the slice.
+    """
+
+    def __init__(self, image, tile_size=256, cache_path=None,
+                 keep_building=None):
+        """
+        Build the pyramid of a slice, or load it from the disk cache.
+
+        Parameters:
+        - image (numpy.ndarray): Grayscale slice
+        - tile_size (int): Edge length of the tiles
+        - cache_path (str, optional): Path prefix to save the levels
+          to, levels already saved there at the right size are memory
+          mapped instead of being built again. Only this slice may be
+          saved under it, see PyramidCache
+        - keep_building (callable, optional): Checked before every
+          level, building stops with the levels so far when it returns
+          False
+
+        Returns:
+        - A new slice pyramid
+        """
+        self.tile_size = tile_size
+        self.levels = [image]
+        level = image
+        while max(level.shape) > tile_size:
+            if keep_building is not None and not keep_building():
+                break
+            size = (max(level.shape[1] // 2, 1), max(level.shape[0] // 2, 1))
+            path = None if cache_path is None else \
+                f"{cache_path}.{len(self.levels)}.npy"
+            cached = None if path is None else \
+                _loadLevel(path, size, image.dtype)
+            if cached is not None:
+                level = cached
+            else:
+                level = cv2.resize(np.asarray(level), size,
+                                   interpolation=cv2.INTER_AREA)
+                if path is not None:
+                    np.save(path, level)
+            self.levels.append(level)
+
+    @property
+    def shape(self):
+        """Get the (height, width) of the full resolution slice."""
+        return self.levels[0].shape
+
+    def compose(self, center_x, center_y, zoom, view_w, view_h):
+        """
+        Compose the view of the slice around a point at a zoom.
+
+        Parameters:
+        - center_x (float): Column of the slice at the view center
+        - center_y (float): Row of the slice at the view center
+        - zoom (float): View pixels per slice pixel
+        - view_w (int): Width of the view
+        - view_h (int): Height of the view
+
+        Returns:
+        - numpy.ndarray: (view_h, view_w) uint8 view, 0 outside the slice
+        """
+        # the smallest level that still has at least one pixel per view pixel
+        level_index = 0
+        if zoom < 1:
+            level_index = min(int(math.log2(1 / zoom)), len(self.levels) - 1)
+        level = self.levels[level_index]
+        scale = zoom * 2 ** level_index
+        center_x /= 2 ** level_index
+        center_y /= 2 ** level_index
+
+        # region of the level covered by the view
+        left = center_x - view_w / (2 * scale)
+        top = center_y - view_h / (2 * scale)
+        x0 = max(int(math.floor(left)), 0)
+        y0 = max(int(math.floor(top)), 0)
+        x1 = min(int(math.ceil(left + view_w / scale)), level.shape[1])
+        y1 = min(int(math.ceil(top + view_h / scale)), level.shape[0])
+        if x1 <= x0 or y1 <= y0:
+            return np.zeros((view_h, view_w), dtype=np.uint8)
+
+        region = self._tiles(level, x0, y0, x1, y1)
+        # scale the region and move it to where it lies in the view
+        transform = np.float32([[scale, 0, (x0 - left) * scale],
+                                [0, scale, (y0 - top) * scale]])
+        interpolation = cv2.INTER_NEAREST if scale >= 1 else cv2.INTER_LINEAR
+        return cv2.warpAffine(region, transform, (view_w, view_h),
+                              flags=interpolation,
+                              borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    def _tiles(self, level, x0, y0, x1, y1):
+        """
+        Copy the visible tiles of a level into one region.
+
+        Parameters:
+        - level (numpy.ndarray): The level, possibly memory mapped
+        - x0, y0, x1, y1 (int): Region of the level to copy
+
+        Returns:
+        - numpy.ndarray: (y1 - y0, x1 - x0) copy of the region
+        """
+        size = self.tile_size
+        region = np.empty((y1 - y0, x1 - x0), dtype=np.uint8)
+        for ty in range(y0 // size, (y1 - 1) // size + 1):
+            for tx in range(x0 // size, (x1 - 1) // size + 1):
+                ty0, tx0 = max(ty * size, y0), max(tx * size, x0)
+                ty1, tx1 = min((ty + 1) * size, y1), min((tx + 1) * size, x1)
+                region[ty0 - y0:ty1 - y0, tx0 - x0:tx1 - x0] = \
+                    level[ty0:ty1, tx0:tx1]
+        return region
+
+
+class PyramidCache():
+    """Build the pyramids of a stack's slices in the background."""
+
+    def __init__(self, images, tile_size=256, cache_dir=None):
+        """
+        Initialize the cache and start building from the first slice.
+
+        Parameters:
+        - images (list of numpy.ndarray): Grayscale slices
+        - tile_size (int): Edge length of the tiles
+        - cache_dir (str, optional): Directory to save the levels to,
+          it must only hold this stack's levels, e.g. name it by
+          utils.stackTag of the stack
+
+        Returns:
+        - A new pyramid cache
+        """
+        self._images = images
+        self._tile_size = tile_size
+        self._cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._pyramids = {}
+        # slices left to build, the front is built first
+        self._queue = deque(range(len(images)))
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def get(self, index):
+        """
+        Get the pyramid of a slice, building it now if it isn't built.
+
+        The neighbouring slices are moved to the front of the queue.
+
+        Parameters:
+        - index (int): The slice
+
+        Returns:
+        - SlicePyramid: the pyramid
+        """
+        with self._lock:
+            pyramid = self._pyramids.get(index)
+        if pyramid is None:
+            pyramid = self._build(index)
+        with self._lock:
+            for neighbour in (index - 1, index + 1):
+                if 0 <= neighbour < len(self._images) and \
+                   neighbour not in self._pyramids:
+                    self._queue.appendleft(neighbour)
+            self._wake.notify()
+        return pyramid
+
+    def close(self):
+        """Stop building pyramids and wait for the level being built."""
+        with self._lock:
+            self._running = False
+            self._wake.notify()
+        self._thread.join()
+
+    def _run(self):
+        """Build the queued slices until every one is built."""
+        while True:
+            with self._lock:
+                while self._running and len(self._queue) == 0:
+                    self._wake.wait()
+                if not self._running:
+                    return
+                index = self._queue.popleft()
+                if index in self._pyramids:
+                    continue
+            self._build(index)
+
+    def _build(self, index):
+        """
+        Build the pyramid of a slice.
+
+        Parameters:
+        - index (int): The slice
+
+        Returns:
+        - SlicePyramid: the pyramid
+        """
+        cache_path = None
+        if self._cache_dir is not None:
+            cache_path = os.path.join(self._cache_dir, f"slice_{index}")
+        pyramid = SlicePyramid(self._images[index], self._tile_size,
+                               cache_path, lambda: self._running)
+        with self._lock:
+            if not self._running:
+                # stopped part way, don't keep the missing levels
+                return pyramid
+            return self._pyramids.setdefault(index, pyramid)
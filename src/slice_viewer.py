@@ -1,16 +1,39 @@
 """Use openCV to view slices and tkinter to create widgets to control the window."""
 import cv2
+import numpy as np
 import tkinter as tk
 from PIL import Image, ImageTk
+from conversions.tiff_to_ply import SLICE_THICKNESS, XY_SCALE
 
+# the axis pointing out of the screen for each view
+_view_axes = {"XY": 0, "XZ": 1, "YZ": 2}
 
-def view_slices(images):
+
+def view_slices(images, pyramid=False, cache_dir=None, view_size=768):
     """
     Display the OpenCV images in a window using Tkinter.
 
+    The stack can be viewed along its acquisition axis (XY) or from the
+    side (XZ, YZ). Side views are strided views of the stack with the
+    depth scaled by the slice thickness. Clicking a view moves the
+    cursor shared by the three views.
+
     Parameters:
-    - images: list of images
+    - images: list of images, or a (depth, height, width) array which
+      the side views read from without copying
+    - pyramid (bool): Show the slices at their own resolution through
+      tile pyramids, drag to pan and scroll to zoom
+    - cache_dir (str, optional): Directory to save the pyramids to,
+      only for this stack, see PyramidCache
+    - view_size (int): Edge length of the view in pyramid mode
     """
+    volume = np.asarray(images)
+    # view pixels per slice along the depth axis of the side views
+    depth_scale = SLICE_THICKNESS / XY_SCALE
+    # cursor in the stack as [slice, row, column]
+    cursor = [0, volume.shape[1] // 2, volume.shape[2] // 2]
+    axis = "XY"
+
     window = tk.Tk()
     window.title("Image Viewer")
 
@@ -18,27 +41,81 @@ def view_slices(images):
     image_label = tk.Label(window)
     image_label.pack()
 
-    # Function to update the displayed image
-    def update_image(index):
-        cv2image = cv2.cvtColor(images[index], cv2.COLOR_BGR2RGB)
+    def show(image, cross=None):
+        if image.ndim == 2:
+            cv2image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+        else:
+            cv2image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        if cross is not None:
+            # draw the cursor, cross is its column and row in the view
+            cv2image[int(cross[1]), :] = (255, 0, 0)
+            cv2image[:, int(cross[0])] = (255, 0, 0)
         pil_image = Image.fromarray(cv2image)
         tk_image = ImageTk.PhotoImage(image=pil_image)
         image_label.config(image=tk_image)
         image_label.image = tk_image
 
+    if pyramid:
+        from slice_pyramid import PyramidCache
+        pyramids = PyramidCache(images, cache_dir=cache_dir)
+        height, width = images[0].shape[:2]
+        # slice pixel at the center of the view and view pixels per
+        # slice pixel, starts fitting the whole slice
+        center = [width / 2, height / 2]
+        zoom = view_size / max(width, height)
+        drag_start = None
+
+    # view rows of the side views, the depth scaled by the slice thickness
+    side_rows = max(int(round(volume.shape[0] * depth_scale)), 1)
+
+    def side_view(index):
+        # strided view of the stack, only the plane is copied when scaled
+        if axis == "XZ":
+            plane = volume[:, index, :]
+        else:
+            plane = volume[:, :, index]
+        # stretched slices stay sharp, squeezed slices are averaged into
+        # their row so none are dropped
+        if side_rows >= plane.shape[0]:
+            interpolation = cv2.INTER_NEAREST_EXACT
+        else:
+            interpolation = cv2.INTER_AREA
+        return cv2.resize(plane, (plane.shape[1], side_rows),
+                          interpolation=interpolation)
+
+    # rows and slices of the side views map through their centers, like
+    # the resize
+    def row_slice(row):
+        return int((row + 0.5) * volume.shape[0] / side_rows)
+
+    def slice_row(index):
+        return int((index + 0.5) * side_rows / volume.shape[0])
+
+    # Function to update the displayed image
+    def update_image(index):
+        if axis == "XY" and pyramid:
+            show(pyramids.get(index).compose(center[0], center[1], zoom,
+                                             view_size, view_size))
+        elif axis == "XY":
+            show(volume[index], (cursor[2], cursor[1]))
+        else:
+            plane = side_view(index)
+            column = cursor[2] if axis == "XZ" else cursor[1]
+            show(plane, (column, slice_row(cursor[0])))
+
+    def slice_count():
+        return volume.shape[_view_axes[axis]]
+
     # Initial image index
     current_index = 0
     update_image(current_index)
 
     # Function to handle keypress events
     def handle_keypress(event):
-        nonlocal current_index
         if event.keysym == "Right":
-            current_index = (current_index + 1) % len(images)
-            update_image(current_index)
+            next_image()
         elif event.keysym == "Left":
-            current_index = (current_index - 1) % len(images)
-            update_image(current_index)
+            prev_image()
 
     # Bind keypress events to the window
     window.bind("<KeyPress>", handle_keypress)
@@ -47,15 +124,38 @@ def view_slices(images):
     # Function to handle button click events
     def next_image():
         nonlocal current_index
-        current_index = (current_index + 1) % len(images)
+        current_index = (current_index + 1) % slice_count()
+        cursor[_view_axes[axis]] = current_index
         update_image(current_index)
-        _updateLabel(index_label, current_index)
+        _updateLabel(index_label, current_index, axis)
 
     def prev_image():
         nonlocal current_index
-        current_index = (current_index - 1) % len(images)
+        current_index = (current_index - 1) % slice_count()
+        cursor[_view_axes[axis]] = current_index
+        update_image(current_index)
+        _updateLabel(index_label, current_index, axis)
+
+    def set_axis(new_axis):
+        nonlocal axis, current_index
+        axis = new_axis
+        current_index = cursor[_view_axes[axis]]
+        update_image(current_index)
+        _updateLabel(index_label, current_index, axis)
+
+    def move_cursor(event):
+        if axis == "XY" and pyramid:
+            return
+        if axis == "XY":
+            cursor[1], cursor[2] = event.y, event.x
+        else:
+            cursor[0] = row_slice(event.y)
+            cursor[1 if axis == "YZ" else 2] = event.x
+        for index, size in enumerate(volume.shape):
+            cursor[index] = min(max(cursor[index], 0), size - 1)
         update_image(current_index)
-        _updateLabel(index_label, current_index)
+
+    image_label.bind("<ButtonPress-1>", move_cursor, add="+")
 
     # Create buttons for navigation
     button_frame = tk.Frame(window)
@@ -64,14 +164,53 @@ def view_slices(images):
     prev_button.pack(side=tk.LEFT)
     next_button = tk.Button(button_frame, text="Next", command=next_image)
     next_button.pack(side=tk.LEFT)
+    for view in _view_axes:
+        tk.Button(button_frame, text=view,
+                  command=lambda view=view: set_axis(view)).pack(side=tk.LEFT)
 
     # Create label to display current index
     index_label = tk.Label(window)
-    _updateLabel(index_label, current_index)
+    _updateLabel(index_label, current_index, axis)
     index_label.pack()
 
+    if pyramid:
+        def start_drag(event):
+            nonlocal drag_start
+            drag_start = (event.x, event.y)
+
+        def drag(event):
+            nonlocal drag_start
+            if axis != "XY":
+                return
+            center[0] -= (event.x - drag_start[0]) / zoom
+            center[1] -= (event.y - drag_start[1]) / zoom
+            drag_start = (event.x, event.y)
+            update_image(current_index)
+
+        def scroll(event):
+            nonlocal zoom
+            if axis != "XY":
+                return
+            zoom_in = event.num == 4 or event.delta > 0
+            factor = 1.25 if zoom_in else 0.8
+            # keep the slice pixel under the cursor in place
+            offset_x = event.x - view_size / 2
+            offset_y = event.y - view_size / 2
+            center[0] += offset_x / zoom - offset_x / (zoom * factor)
+            center[1] += offset_y / zoom - offset_y / (zoom * factor)
+            zoom *= factor
+            update_image(current_index)
+
+        image_label.bind("<ButtonPress-1>", start_drag, add="+")
+        image_label.bind("<B1-Motion>", drag)
+        image_label.bind("<MouseWheel>", scroll)
+        image_label.bind("<Button-4>", scroll)
+        image_label.bind("<Button-5>", scroll)
+
     # Start the Tkinter main loop
     window.mainloop()
+    if pyramid:
+        pyramids.close()
 
-def _updateLabel(label, current_index):
-    label.config(text=f"Index: {current_index + 1}")
+def _updateLabel(label, current_index, axis="XY"):
+    label.config(text=f"{axis} Index: {current_index + 1}")
@@ -13,6 +13,11 @@ class _TaichiThread(threading.Thread):
     def __init__(self, visualizer, q):
         self.q = q
         self.visualizer = visualizer
+        self._latest_threshold = None
+        # points for a new threshold waiting to be loaded by the thread
+        # that renders, with the status to show for them
+        self._pending_points = None
+        self._pending_lock = threading.Lock()
         super(_TaichiThread, self).__init__()
 
     def beginRendering(self):
@@ -52,9 +57,52 @@ class _TaichiThread(threading.Thread):
     def queueSetRotationV(self, deg):
         self.onThread(self.visualizer.setCameraRotationV, deg)
 
+    def queueSetThreshold(self, threshold_cache, threshold, decimation=None):
+        self._latest_threshold = threshold
+        self.onThread(self._setThreshold, threshold_cache, threshold,
+                      decimation)
+
+    def _setThreshold(self, threshold_cache, threshold, decimation=None):
+        # skip stale requests while the slider is still moving
+        if threshold != self._latest_threshold:
+            return
+        points = threshold_cache.setThreshold(threshold)
+        status = None
+        if decimation is not None:
+            points = decimation(points)
+            status = decimation.describe()
+        # taichi isn't thread safe, the rendering thread loads the points
+        with self._pending_lock:
+            self._pending_points = (points, status)
+
+    def applyPendingPoints(self, arena):
+        """
+        Load the points of the latest threshold into the arena and draw them.
+
+        Has to be called on the thread that renders, since loading can
+        destroy the field and runs kernels.
+
+        Parameters:
+            - arena (FieldArena): Arena holding the drawn points
+
+        Returns:
+            - bool: whether new points were loaded
+        """
+        with self._pending_lock:
+            pending, self._pending_points = self._pending_points, None
+        if pending is None:
+            return False
+        points, status = pending
+        arena.load(points)
+        self.visualizer.setPoints(arena.field, arena.count)
+        if status is not None:
+            self.visualizer.status = status
+        return True
+
 
 # make the proper things private in the Particlevisualizer class
-def renderUI(points):
+def renderUI(points, num_points=None, threshold_cache=None, arena=None,
+             show_hud=False, metrics_path=None, decimation=None):
     """
     Create 2 windows to render and manipulate the point cloud.
 
@@ -62,6 +110,17 @@ def renderUI(points):
 
     Parameters:
         - Points (taichi.Vector.field): the points to render
+        - num_points (int, optional): Number of live points at the start
+          of the field, defaults to the whole field
+        - threshold_cache (ThresholdCache, optional): Adds a slider to
+          change the mask threshold of the stack the points came from
+        - arena (FieldArena, optional): Arena holding the points, the
+          points for a new threshold are loaded into it
+        - show_hud (bool): Draw the performance overlay
+        - metrics_path (str, optional): File to export the frame metrics
+          to when the windows close
+        - decimation (Decimation, optional): Stage reducing the points
+          for a new threshold before they are loaded
 
     Create the tk window in this file
     Returns:
@@ -77,7 +136,11 @@ def renderUI(points):
     window.grid_columnconfigure(0, weight=weight)
     window.grid_columnconfigure(1, weight=weight)
 
-    visualizer = ParticleVisualizer("Visualizer", points)
+    visualizer = ParticleVisualizer("Visualizer", points, num_points,
+                                    show_hud=show_hud,
+                                    metrics_path=metrics_path)
+    if decimation is not None and decimation.report is not None:
+        visualizer.status = decimation.describe()
     taichi_thread = _TaichiThread(visualizer, queue.Queue())
 
     move_dist = 5
@@ -104,19 +167,32 @@ def renderUI(points):
     h_curr_angle = h_angle_scroll.get()
     v_curr_angle = v_angle_scroll.get()
     # angle_scroll.grid(row=1, column=0)
+    if threshold_cache is not None:
+        if arena is None:
+            from conversions.field_arena import FieldArena
+            arena = FieldArena()
+        window.grid_rowconfigure(2, weight=weight)
+        threshold_scroll = tk.Scale(window, from_=0, to=255,
+                                    orient=tk.HORIZONTAL, label="Threshold")
+        threshold_scroll.set(threshold_cache.threshold)
+        threshold_scroll.grid(row=2, column=0, columnspan=2)
+        curr_threshold = threshold_scroll.get()
     was_change = True
     # render the first time and creates the visualizer
     global SHOULD_SHOW
     if SHOULD_SHOW:
         SHOULD_SHOW = False
         visualizer.render()
-        visualizer.window.show()
+        visualizer.show()
     taichi_thread.beginRendering()
     while taichi_thread.is_alive() and _tk_window_active(window):
+        if threshold_cache is not None and \
+           taichi_thread.applyPendingPoints(arena):
+            SHOULD_SHOW = True
         if SHOULD_SHOW:
             SHOULD_SHOW = False
             visualizer.render()
-            visualizer.window.show()
+            visualizer.show()
         new_angle = h_angle_scroll.get()
         if new_angle != h_curr_angle:
             h_curr_angle = new_angle
@@ -125,6 +201,12 @@ def renderUI(points):
         if new_angle != v_curr_angle:
             v_curr_angle = new_angle
             taichi_thread.queueSetRotationV(v_curr_angle)
+        if threshold_cache is not None:
+            new_threshold = threshold_scroll.get()
+            if new_threshold != curr_threshold:
+                curr_threshold = new_threshold
+                taichi_thread.queueSetThreshold(threshold_cache,
+                                                curr_threshold, decimation)
         # render the tkinter window
         window.update()
         # render the visualizer window
@@ -142,6 +224,7 @@ def renderUI(points):
         taichi_thread.join()
         taichi_thread.visualizer.window.destroy()
 
+    visualizer.exportMetrics()
     print("exiting normally")
 
 
@@ -1,5 +1,8 @@
 """Utils to help with: file/dir readings."""
+import hashlib
+import re
 import cv2
+import numpy as np
 import os
 
 def isFileEnding(path, file_endings):
@@ -13,6 +16,70 @@ def isFileEnding(path, file_endings):
     return any(path.endswith(end) for end in file_endings)
 
 
+def _naturalKey(name):
+    """
+    Get a sort key that orders the numbers in names by value.
+
+    Parameters:
+        - name: The name to sort by
+
+    Returns:
+        - list: the text and number parts of the name, t2 sorts before t10
+    """
+    return [int(part) if part.isdigit() else part.lower()
+            for part in re.split(r"(\d+)", name)]
+
+
+def listStacks(path, file_endings):
+    """
+    Find the stacks in a directory, in natural order of their names.
+
+    A stack is a file with one of the file endings or a directory
+    containing such files.
+
+    Parameters:
+        - path: The directory to search
+        - file_endings: A list of file endings
+
+    Returns:
+        - dict: stack name to its path, the name of a file keeps its
+          extension so a .tif and a .ply with the same stem don't collide
+    """
+    stacks = {}
+    for entry in sorted(os.listdir(path), key=_naturalKey):
+        entry_path = os.path.join(path, entry)
+        if os.path.isdir(entry_path):
+            if any(isFileEnding(file, file_endings)
+                   for file in os.listdir(entry_path)):
+                stacks[entry] = entry_path
+        elif isFileEnding(entry, file_endings):
+            stacks[entry] = entry_path
+    return stacks
+
+
+def stackTag(source, settings=()):
+    """
+    Get a tag that changes when a stack or the settings it is read with change.
+
+    Parameters:
+        - source: Path to a stack file or a directory of slices
+        - settings: Anything with a stable repr that the result depends on
+
+    Returns:
+        - str: 16 hex digits from the settings and the path, size and
+          modification time of every file of the stack
+    """
+    paths = [source]
+    if os.path.isdir(source):
+        paths = [os.path.join(source, file)
+                 for file in sorted(os.listdir(source))]
+    digest = hashlib.sha1(repr(settings).encode())
+    for path in paths:
+        stat = os.stat(path)
+        digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()[:16]
+
+
 def readPathForFiles(path, file_endings, size):
     """
     Read a file or a directory and returns matching files.
@@ -23,6 +90,9 @@ def readPathForFiles(path, file_endings, size):
                     this returns nothing
        - tif/tiff: Read a stacked image or single image
                     with openCV
+
+    The slices are resized to size, or kept at their own size if size
+    is None, and returned as one (depth, height, width) uint8 array.
     """
     flag = cv2.IMREAD_GRAYSCALE
     if os.path.isdir(path):
@@ -38,6 +108,176 @@ def readPathForFiles(path, file_endings, size):
     return images
 
 
+# reduced decode flags and how much they shrink the image
+_reduced_flags = [(8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+                  (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+                  (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)]
+
+
+def _reducedFlag(shape, size, flag):
+    """
+    Pick the most reduced decode flag that stays at or above size.
+
+    Parameters:
+    - shape (tuple): (height, width) of the full image
+    - size (tuple): (width, height) the image is resized to
+    - flag (int): Flag to use when no reduction fits
+
+    Returns:
+    - int: flag to read the image with
+    """
+    if size is None or flag != cv2.IMREAD_GRAYSCALE:
+        return flag
+    for scale, reduced in _reduced_flags:
+        if shape[1] // scale >= size[0] and shape[0] // scale >= size[1]:
+            return reduced
+    return flag
+
+
+def _fitImage(img, size, out=None):
+    """
+    Write an image into a slice of the output array, resizing if needed.
+
+    Parameters:
+    - img (numpy.ndarray): The loaded image
+    - size (tuple): Size to resize to, None keeps the size
+    - out (numpy.ndarray, optional): Slice of the output array to write
+      to, the image or a resized copy is returned without it
+
+    Returns:
+    - numpy.ndarray: the fitted image
+    """
+    if size is None or img.shape[::-1] == tuple(size):
+        if out is None:
+            return img
+        out[...] = img
+    else:
+        out = cv2.resize(img, tuple(size), dst=out)
+    return out
+
+
+def iterPathForFiles(path, file_endings, size):
+    """
+    Decode the slices of a file or a directory one at a time, in order.
+
+    Lets a consumer start on the first slices before the rest of the
+    stack is decoded. Reads the same files as readPathForFiles.
+
+    Parameters:
+        - path: The tif/tiff file or directory to read
+        - file_endings: A list of file endings
+        - size: Size the slices are resized to, None keeps their size
+
+    Returns:
+        - int: number of slices
+        - generator: every (height, width) uint8 slice
+        - or None if the path isn't a supported image type
+    """
+    flag = cv2.IMREAD_GRAYSCALE
+    if os.path.isdir(path):
+        count, decoded = _decodeDir(path, file_endings, size, flag)
+    elif isFileEnding(path, [".tif", ".tiff"]):
+        count, decoded = _decodeFile(path, size, flag)
+    else:
+        return None
+    return count, (_fitImage(img, size) for img in decoded)
+
+
+def _decodeDir(folder, file_endings, size, flag):
+    """
+    Decode the images of a directory with specified file endings in order.
+
+    The first image is decoded fully, the rest are decoded at the most
+    reduced resolution that still fits size.
+
+    Parameters:
+    - folder (str): Path to the directory containing the images.
+    - file_endings (list): List of file endings (e.g., [".tif", ".tiff"])
+    to filter the images.
+    - size (tuple): Size the images will be resized to.
+    - flag (int): Flag indicating the color mode for reading the images.
+
+    Returns:
+    - int: number of images
+    - generator: every decoded image
+    """
+    files = [file for file in os.listdir(folder)
+             if isFileEnding(file, [".tif", ".tiff"])]
+
+    def decode():
+        read_flag = flag
+        for index, file in enumerate(files):
+            img = cv2.imread(os.path.join(folder, file), read_flag)
+            if index == 0:
+                read_flag = _reducedFlag(img.shape, size, flag)
+            yield img
+    return len(files), decode()
+
+
+def _decodeFile(path, size, flag, batch_bytes=256 * 2**20):
+    """
+    Decode the pages of a single, stacked tiff file in order.
+
+    Pages are read in batches of at most about batch_bytes of decoded
+    pixels so only some full resolution pages are held at once. Every
+    read seeks from the first page, so batches double up to that size,
+    which gives the first pages quickly in a few reads overall.
+
+    Parameters:
+    - path (str): Path to the image file.
+    - size (tuple): Size the images will be resized to.
+    - flag (int): Flag indicating the color mode for reading the images.
+    - batch_bytes (int): Decoded bytes to read at a time.
+
+    Returns:
+    - int: number of pages
+    - generator: every decoded page
+    """
+    count = cv2.imcount(path)
+
+    def decode():
+        start = 0
+        batch = 1
+        while start < count:
+            read, loaded = cv2.imreadmulti(path, start,
+                                           min(batch, count - start),
+                                           flags=flag)
+            if not read:
+                # TODO make this an error type
+                print("Couldn't Read File")
+                exit(1)
+            batch = min(batch * 2, max(batch_bytes // loaded[0].nbytes, 1))
+            start += len(loaded)
+            yield from loaded
+            # let the batch go before the next one is read
+            del loaded
+    return count, decode()
+
+
+def _stackImages(count, decoded, size):
+    """
+    Fit decoded images into one array.
+
+    Parameters:
+    - count (int): Number of images
+    - decoded (iterable): The decoded images, in order
+    - size (tuple): Size to resize to, None keeps the size of the first
+
+    Returns:
+    - numpy.ndarray: (depth, height, width) array of the images, None
+    if there were none
+    """
+    images = None
+    for index, img in enumerate(decoded):
+        if images is None:
+            # the first image gives the shape of the stack
+            out_size = img.shape[::-1] if size is None else size
+            images = np.empty((count, out_size[1], out_size[0]),
+                              dtype=np.uint8)
+        _fitImage(img, size, images[index])
+    return images
+
+
 def _getImagesFromDir(folder, file_endings, size, flag):
     """
     Load images from a directory with specified file endings.
@@ -50,16 +290,13 @@ def _getImagesFromDir(folder, file_endings, size, flag):
     - flag (int): Flag indicating the color mode for reading the images.
 
     Returns:
-    - list: List of loaded and resized images from the directory.
+    - numpy.ndarray: (depth, height, width) array of the loaded and
+    resized images from the directory.
     """
-    files = os.listdir(folder)
-    images = []
-    for file in files:
-        is_tif = isFileEnding(file, [".tif", ".tiff"])
-        if is_tif:
-            img = cv2.imread(os.path.join(folder, file), flag)
-            img = cv2.resize(img, size)
-            images.append(img)
+    images = _stackImages(*_decodeDir(folder, file_endings, size, flag),
+                          size)
+    if images is None:
+        return np.empty((0, 0, 0), dtype=np.uint8)
     return images
 
 
@@ -73,16 +310,11 @@ def _getImagesFromFile(path, size, flag):
     - flag (int): Flag indicating the color mode for reading the images.
 
     Returns:
-    - list: List of loaded and resized images from the file.
+    - numpy.ndarray: (depth, height, width) array of the loaded and
+    resized images from the file.
     """
-    images = []
-    read, loaded = cv2.imreadmulti(path, flags=flag)
-    if not read:
-        # TODO make this an error type
+    images = _stackImages(*_decodeFile(path, size, flag), size)
+    if images is None:
         print("Couldn't Read File")
         exit(1)
-    for img in loaded:
-        # change here for more or less resolution
-        img = cv2.resize(img, size)
-        images.append(img)
     return images
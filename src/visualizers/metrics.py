@@ -0,0 +1,140 @@
+"""
+Per frame metrics of a visualizer and their export.
+
+Exported classes FrameMetrics
+"""
+from collections import deque
+import csv
+import json
+import platform
+import numpy as np
+
+_phases = ("input", "scene", "present")
+
+
+class FrameMetrics():
+    """Record the time and points of every frame of a session."""
+
+    def __init__(self, window=120):
+        """
+        Initialize empty metrics.
+
+        Parameters:
+        - window (int): Number of recent frames summarized by the HUD
+
+        Returns:
+        - New frame metrics
+        """
+        self.frames = []
+        self._recent = deque(maxlen=window)
+
+    def record(self, frame_time, points, input_time, scene_time,
+               present_time):
+        """
+        Record a frame.
+
+        Parameters:
+        - frame_time (float): Seconds since the previous frame
+        - points (int): Points submitted to the scene
+        - input_time (float): Seconds spent handling input
+        - scene_time (float): Seconds spent building the scene
+        - present_time (float): Seconds spent presenting the window
+        """
+        frame = {"frame_time": frame_time, "points": points,
+                 "input": input_time, "scene": scene_time,
+                 "present": present_time}
+        self.frames.append(frame)
+        self._recent.append(frame)
+
+    def fps(self):
+        """
+        Get the frames per second over the recent frames.
+
+        Returns:
+        - float: frames per second, 0 before any frame
+        """
+        total = sum(frame["frame_time"] for frame in self._recent)
+        if total <= 0:
+            return 0.0
+        return len(self._recent) / total
+
+    def phaseAverages(self):
+        """
+        Get the average seconds of each phase over the recent frames.
+
+        Returns:
+        - dict: phase name to seconds
+        """
+        if len(self._recent) == 0:
+            return {phase: 0.0 for phase in _phases}
+        return {phase: sum(frame[phase] for frame in self._recent) /
+                len(self._recent) for phase in _phases}
+
+    def histogram(self, bins=8, max_ms=66.0):
+        """
+        Count the recent frame times in equal width millisecond bins.
+
+        Parameters:
+        - bins (int): Number of bins, the last one holds anything slower
+        - max_ms (float): Upper edge of the bins
+
+        Returns:
+        - list of (float, int): lower edge of each bin and its count
+        """
+        width = max_ms / bins
+        counts = [0] * bins
+        for frame in self._recent:
+            index = int(frame["frame_time"] * 1e3 / width)
+            counts[min(index, bins - 1)] += 1
+        return [(index * width, count) for index, count in enumerate(counts)]
+
+    def summary(self):
+        """
+        Summarize the whole session.
+
+        Returns:
+        - dict: frame count, mean fps, frame time percentiles in ms
+          and the mean ms of each phase
+        """
+        if len(self.frames) == 0:
+            return {"frames": 0}
+        times = np.array([frame["frame_time"] for frame in self.frames])
+        summary = {"frames": len(self.frames),
+                   "mean_fps": len(times) / times.sum() if times.sum() else 0,
+                   "mean_points": float(np.mean([frame["points"]
+                                                 for frame in self.frames]))}
+        for percentile in (50, 95, 99):
+            summary[f"p{percentile}_ms"] = \
+                float(np.percentile(times, percentile) * 1e3)
+        for phase in _phases:
+            summary[f"{phase}_ms"] = float(np.mean(
+                [frame[phase] for frame in self.frames]) * 1e3)
+        return summary
+
+    def export(self, path):
+        """
+        Write every frame to a file, CSV if path ends in .csv else JSON.
+
+        The JSON file also holds a summary and the machine it ran on.
+
+        Parameters:
+        - path (str): File to write
+
+        Returns:
+        - str: the path
+        """
+        columns = ("frame_time", "points") + _phases
+        if path.endswith(".csv"):
+            with open(path, "w", newline="") as file:
+                writer = csv.writer(file)
+                writer.writerow(("frame",) + columns)
+                for index, frame in enumerate(self.frames):
+                    writer.writerow([index] + [frame[c] for c in columns])
+        else:
+            with open(path, "w") as file:
+                json.dump({"machine": {"platform": platform.platform(),
+                                       "processor": platform.processor(),
+                                       "python": platform.python_version()},
+                           "summary": self.summary(),
+                           "frames": self.frames}, file, indent=1)
+        return path
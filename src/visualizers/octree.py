@@ -0,0 +1,210 @@
+"""
+Octree over a point array for culling points outside the camera's view.
+
+Points are put in Morton order, so every octree node is a contiguous
+range of them and the visible part of the cloud is a few ranges.
+
+Exported classes PointOctree
+Exported functions cameraFrustum, bruteForceCull
+Private functions begin with an _
+"""
+import math
+import time
+import numpy as np
+from conversions.morton import mortonCodes
+
+# bits of every axis in the morton codes
+_bits = 21
+
+
+def cameraFrustum(position, lookat, up, fov=45.0, aspect=1.0, near=0.1,
+                  far=1000.0):
+    """
+    Get the planes bounding what a perspective camera sees.
+
+    Parameters:
+    - position (array like): Position of the camera
+    - lookat (array like): Point the camera looks at
+    - up (array like): Up direction of the camera
+    - fov (float): Vertical field of view in degrees
+    - aspect (float): Width over height of the window
+    - near (float): Distance to the near plane
+    - far (float): Distance to the far plane
+
+    Returns:
+    - numpy.ndarray: (6, 4) planes (a, b, c, d) with unit normals that
+      point inward, a point p is inside when a, b, c . p + d >= 0 for
+      every plane
+    """
+    position = np.asarray(position, dtype=np.float64)
+    front = np.asarray(lookat, dtype=np.float64) - position
+    front /= np.linalg.norm(front)
+    right = np.cross(front, np.asarray(up, dtype=np.float64))
+    right /= np.linalg.norm(right)
+    true_up = np.cross(right, front)
+    tan_v = math.tan(math.radians(fov) / 2)
+    tan_h = tan_v * aspect
+    normals = np.array([front, -front,
+                        tan_h * front + right, tan_h * front - right,
+                        tan_v * front + true_up, tan_v * front - true_up])
+    normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+    offsets = -normals @ position
+    offsets[0] -= near
+    offsets[1] += far
+    return np.column_stack((normals, offsets))
+
+
+def bruteForceCull(points, planes, radius=0.0):
+    """
+    Test every point against the view, for checking PointOctree.cull.
+
+    Parameters:
+    - points (numpy.ndarray): (n, 3) array of points
+    - planes (numpy.ndarray): (6, 4) planes from cameraFrustum
+    - radius (float): Radius of the drawn points, points whose sphere
+      touches the view count as visible
+
+    Returns:
+    - numpy.ndarray: (n,) bool, whether each point is visible
+    """
+    distances = points @ planes[:, :3].T + planes[:, 3]
+    return np.all(distances >= -radius, axis=1)
+
+
+class PointOctree():
+    """
+    An octree whose nodes are contiguous ranges of Morton ordered points.
+
+    Nodes with more than leaf_points points are split into their
+    occupied octants. Every node keeps the tight bounds of its points.
+    """
+
+    def __init__(self, points, leaf_points=4096, max_depth=12):
+        """
+        Order the points and build the octree over them.
+
+        Parameters:
+        - points (numpy.ndarray): (n, 3) array of points
+        - leaf_points (int): Nodes with at most this many points aren't
+          split
+        - max_depth (int): Deepest level of the octree
+
+        Returns:
+        - A new octree, the reordered points are in points and the
+          original index of every point in order
+        """
+        start_time = time.perf_counter()
+        points = np.asarray(points, dtype=np.float32)
+        codes = mortonCodes(points)[0]
+        self.order = np.argsort(codes)
+        self.points = points[self.order]
+        codes = codes[self.order]
+
+        # per level: node starts, counts, bounds, whether they are
+        # leaves and the range of their children in the next level
+        self._starts, self._counts = [], []
+        self._mins, self._maxs, self._leaves = [], [], []
+        self._children = []
+        starts = np.zeros(min(len(points), 1), dtype=np.int64)
+        ends = np.full(len(starts), len(points), dtype=np.int64)
+        for level in range(max_depth + 1):
+            counts = ends - starts
+            leaves = (counts <= leaf_points) | (level == max_depth)
+            self._starts.append(starts)
+            self._counts.append(counts)
+            self._leaves.append(leaves)
+            if len(starts) > 0:
+                self._mins.append(np.minimum.reduceat(self.points, starts))
+                self._maxs.append(np.maximum.reduceat(self.points, starts))
+            else:
+                self._mins.append(np.empty((0, 3), dtype=np.float32))
+                self._maxs.append(np.empty((0, 3), dtype=np.float32))
+            if np.all(leaves):
+                break
+            # octants of the nodes that are split
+            prefix = codes >> np.uint64(3 * (_bits - level - 1))
+            boundaries = np.flatnonzero(prefix[1:] != prefix[:-1]) + 1
+            child_starts = np.union1d(boundaries, starts)
+            split_ranges = np.searchsorted(child_starts,
+                                           np.stack((starts, ends)))
+            keep = np.zeros(len(child_starts) + 1, dtype=np.int64)
+            np.add.at(keep, split_ranges[0][~leaves], 1)
+            np.add.at(keep, split_ranges[1][~leaves], -1)
+            keep = np.cumsum(keep)[:-1] > 0
+            next_starts = child_starts[keep]
+            next_ends = np.append(child_starts[1:], len(points))[keep]
+            first = np.searchsorted(next_starts, starts)
+            last = np.searchsorted(next_starts, ends)
+            first[leaves] = last[leaves] = 0
+            self._children.append(np.stack((first, last), axis=1))
+            starts, ends = next_starts, next_ends
+        self._children.append(np.zeros((len(starts), 2), dtype=np.int64))
+        self.build_time = time.perf_counter() - start_time
+
+    def __len__(self):
+        return len(self.points)
+
+    @property
+    def nodes(self):
+        """Get the number of nodes in the octree."""
+        return sum(len(starts) for starts in self._starts)
+
+    def cull(self, planes, radius=0.0, max_ranges=16):
+        """
+        Find the ranges of points that may be inside the view.
+
+        Nodes inside the view are taken whole, nodes crossing it are
+        split down to the leaves, which are taken whole. Every point
+        brute force culling keeps is in the ranges.
+
+        Parameters:
+        - planes (numpy.ndarray): (6, 4) planes from cameraFrustum
+        - radius (float): Radius of the drawn points
+        - max_ranges (int): Most ranges to return, the ranges with the
+          smallest gaps between them are joined to stay under it. Every
+          range is a copy when they are gathered for drawing
+
+        Returns:
+        - list of (int, int): offset and count of every range
+        """
+        normals = planes[:, :3]
+        taken_starts, taken_counts = [], []
+        nodes = np.zeros(min(len(self.points), 1), dtype=np.int64)
+        for level in range(len(self._starts)):
+            if len(nodes) == 0:
+                break
+            mins = self._mins[level][nodes]
+            maxs = self._maxs[level][nodes]
+            centers = (mins + maxs) / 2
+            extents = (maxs - mins) / 2
+            distances = centers @ normals.T + planes[:, 3]
+            reach = extents @ np.abs(normals).T
+            outside = np.any(distances + reach < -radius, axis=1)
+            inside = np.all(distances - reach >= -radius, axis=1)
+            take = ~outside & (inside | self._leaves[level][nodes])
+            taken_starts.append(self._starts[level][nodes[take]])
+            taken_counts.append(self._counts[level][nodes[take]])
+            split = nodes[~outside & ~take]
+            children = self._children[level][split]
+            sizes = children[:, 1] - children[:, 0]
+            # the ranges of children concatenated
+            nodes = np.repeat(children[:, 0] - np.cumsum(sizes) + sizes,
+                              sizes) + np.arange(sizes.sum())
+        if len(taken_starts) == 0:
+            return []
+        starts = np.concatenate(taken_starts)
+        if len(starts) == 0:
+            return []
+        ends = starts + np.concatenate(taken_counts)
+        order = np.argsort(starts)
+        starts, ends = starts[order], ends[order]
+        # join touching ranges, then the closest ones if there are too many
+        gaps = starts[1:] - ends[:-1]
+        split = gaps > 0
+        if split.sum() >= max_ranges:
+            smallest = np.argsort(gaps, kind="stable")
+            split[smallest[:len(gaps) - (max_ranges - 1)]] = False
+        firsts = np.concatenate(([0], np.flatnonzero(split) + 1))
+        lasts = np.concatenate((np.flatnonzero(split), [len(starts) - 1]))
+        return [(int(start), int(end - start))
+                for start, end in zip(starts[firsts], ends[lasts])]
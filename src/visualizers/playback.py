@@ -0,0 +1,262 @@
+"""
+Play back a time series of stacks as an animated point cloud.
+
+Exported classes TimeSeriesPlayer
+Private functions begin with an _
+"""
+import threading
+import time
+import numpy as np
+from conversions.field_arena import FieldArena
+from conversions.ply_to_cloud import readPlyPoints
+from conversions.tiff_to_ply import extractPoints
+from utils import isFileEnding, readPathForFiles
+
+
+def _loadTimepoint(source, size, threshold):
+    """
+    Get the points of one timepoint.
+
+    Parameters:
+    - source (str): A PLY file, or a tiff stack or directory of slices
+    - size (tuple): Size the slices are resized to before extracting
+    - threshold (int): Highest intensity kept in the masks
+
+    Returns:
+    - numpy.ndarray: (n, 3) float32 array of points
+    """
+    if isFileEnding(source, [".ply"]):
+        return readPlyPoints(source)
+    images = readPathForFiles(source, [".tif", ".tiff"], size)
+    return extractPoints(images, threshold)
+
+
+class TimeSeriesPlayer():
+    """
+    Load timepoints ahead of playback and upload them double buffered.
+
+    A background thread extracts the points of the next timepoints.
+    The render thread uploads the next one into the back field while
+    the front field is drawn, and swaps the fields when it is due.
+    """
+
+    def __init__(self, sources, size=(128, 128), threshold=None, fps=10.0,
+                 prefetch=4):
+        """
+        Initialize the player and start loading the first timepoints.
+
+        Parameters:
+        - sources (list of str): Stacks or PLY files, one per timepoint
+        - size (tuple): Size slices are resized to before extracting
+        - threshold (int, optional): Highest intensity kept in the masks
+        - fps (float): Timepoints shown per second while playing
+        - prefetch (int): Number of timepoints kept loaded ahead
+
+        Returns:
+        - A new player
+        """
+        self._sources = list(sources)
+        self._size = size
+        self._threshold = threshold
+        self.fps = fps
+        self._prefetch = prefetch
+        self.playing = True
+        # timepoint drawn from the front field
+        self.current = None
+        # timepoint to show next
+        self._target = 0
+        self._last_advance = None
+
+        self._front = FieldArena()
+        self._back = FieldArena()
+        self._back_timepoint = None
+
+        self.dropped_frames = 0
+        self.upload_times = []
+        # error of every timepoint that couldn't be loaded, they are
+        # shown without points
+        self.errors = {}
+
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._loaded = {}
+        self._running = True
+        self._thread = threading.Thread(target=self._load, daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        return len(self._sources)
+
+    @property
+    def field(self):
+        """Get the field holding the current timepoint."""
+        return self._front.field
+
+    @property
+    def count(self):
+        """Get the number of points in the current timepoint."""
+        return self._front.count
+
+    def togglePlaying(self):
+        """Pause or resume playback."""
+        self.playing = not self.playing
+        self._last_advance = None
+
+    def scrub(self, timepoint):
+        """
+        Jump to a timepoint.
+
+        Parameters:
+        - timepoint (int): The timepoint to show next
+        """
+        with self._lock:
+            self._target = timepoint % len(self._sources)
+            self._wake.notify()
+        self._last_advance = None
+
+    def update(self):
+        """
+        Advance playback, call once per frame on the render thread.
+
+        Returns:
+        - bool: whether the front field changed
+        """
+        now = time.perf_counter()
+        num_timepoints = len(self._sources)
+        # the target only moves once it is shown, so a slow load holds
+        # the current timepoint instead of running ahead of the loader
+        if self.playing and self.current is not None and \
+           self._target == self.current:
+            if self._last_advance is None:
+                self._last_advance = now
+            interval = 1 / self.fps
+            late = now - self._last_advance
+            if late >= interval:
+                steps = min(int(late / interval), num_timepoints)
+                with self._lock:
+                    # skip due timepoints only to one that is loaded,
+                    # otherwise wait for the next one
+                    step = 1
+                    for ahead in range(steps, 1, -1):
+                        if (self.current + ahead) % num_timepoints in \
+                           self._loaded:
+                            step = ahead
+                            break
+                    self._target = (self.current + step) % num_timepoints
+                    self._wake.notify()
+                # timepoints that were due but skipped are dropped
+                self.dropped_frames += step - 1
+                self._last_advance += step * interval
+
+        # upload the timepoint that is due next into the back field
+        upcoming = self._target if self._target != self.current else \
+            (self._target + 1) % len(self._sources)
+        if self._back_timepoint != upcoming:
+            with self._lock:
+                points = self._loaded.get(upcoming)
+            if points is not None:
+                start = time.perf_counter()
+                self._back.load(points)
+                self.upload_times.append(time.perf_counter() - start)
+                self._back_timepoint = upcoming
+
+        changed = False
+        if self._back_timepoint == self._target and \
+           self._target != self.current:
+            if self._last_advance is not None and \
+               now - self._last_advance >= 1 / self.fps:
+                # it was waited for, its interval starts now
+                self._last_advance = now
+            self._front, self._back = self._back, self._front
+            self._back_timepoint = self.current
+            self.current = self._target
+            changed = True
+        return changed
+
+    def status(self):
+        """
+        Describe the playback state.
+
+        Returns:
+        - str: current timepoint, dropped frames, upload time and the
+          timepoints that couldn't be loaded
+        """
+        current = "-" if self.current is None else self.current + 1
+        upload = 0.0
+        if len(self.upload_times) > 0:
+            upload = sum(self.upload_times) / len(self.upload_times) * 1e3
+        status = (f"Timepoint {current}/{len(self._sources)}, "
+                  f"dropped {self.dropped_frames}, upload {upload:.1f} ms")
+        with self._lock:
+            failed = sorted(self.errors.items())
+        if len(failed) > 0:
+            timepoint, error = failed[0]
+            status += (f", {len(failed)} failed to load, "
+                       f"{timepoint + 1}: {error}")
+        return status
+
+    def drawControls(self, gui):
+        """
+        Draw play, pause and scrub controls.
+
+        Parameters:
+        - gui (ti.ui.Gui): The gui of the window
+        """
+        with gui.sub_window("Playback", 0.01, 0.85, 0.6, 0.14) as w:
+            if w.button("Pause" if self.playing else "Play"):
+                self.togglePlaying()
+            shown = 0 if self.current is None else self.current
+            picked = w.slider_int("Timepoint", shown, 0,
+                                  len(self._sources) - 1)
+            if picked != shown:
+                self.scrub(picked)
+            self.fps = w.slider_float("FPS", self.fps, 1.0, 60.0)
+            w.text(self.status())
+
+    def close(self):
+        """Stop loading and free the fields."""
+        with self._lock:
+            self._running = False
+            self._wake.notify()
+        self._thread.join()
+        self._front.destroy()
+        self._back.destroy()
+
+    def _load(self):
+        """Keep the timepoints after the target loaded."""
+        while True:
+            with self._lock:
+                while True:
+                    if not self._running:
+                        return
+                    wanted = [(self._target + offset) % len(self._sources)
+                              for offset in range(self._prefetch + 1)]
+                    # forget timepoints that fell out of the window, the
+                    # target only moves past timepoints once they are
+                    # shown or skipped
+                    for timepoint in list(self._loaded):
+                        if timepoint not in wanted:
+                            del self._loaded[timepoint]
+                    missing = [timepoint for timepoint in wanted
+                               if timepoint not in self._loaded]
+                    if len(missing) > 0:
+                        break
+                    self._wake.wait()
+            timepoint = missing[0]
+            error = None
+            try:
+                points = _loadTimepoint(self._sources[timepoint],
+                                        self._size, self._threshold)
+            except SystemExit:
+                # readPathForFiles exits when it can't read a stack
+                error = "couldn't read the stack"
+            except Exception as exception:
+                error = str(exception) or type(exception).__name__
+            if error is not None:
+                points = np.empty((0, 3), dtype=np.float32)
+            with self._lock:
+                self._loaded[timepoint] = points
+                if error is None:
+                    self.errors.pop(timepoint, None)
+                else:
+                    self.errors[timepoint] = error
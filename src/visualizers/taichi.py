@@ -1,11 +1,16 @@
 """Contain a visualizer that spawns a window utilizing taichi."""
 from taichi.lang.matrix import Vector
 from visualizers.utils import vecToEuler, eulerToVec
+from conversions.field_arena import StagingFields
+from visualizers.metrics import FrameMetrics
+from visualizers.octree import PointOctree, cameraFrustum
 from __main__ import ti
+import numpy as np
 import time
 import math
 
-def render(points):
+def render(points, num_points=None, budgeted=False, show_hud=False,
+           metrics_path=None, culled=False):
     """
     Repeatedly draws points to the window.
 
@@ -21,34 +26,321 @@ def render(points):
     - points (ti.vector.Field) containing
     the centers of the points
     - ti (ti): The initialized taichi object
+    - num_points (int, optional): Number of live points at the start
+      of the field, defaults to the whole field
+    - budgeted (bool): Only draw as many points as fit in a frame
+      while moving, see ParticleVisualizer
+    - show_hud (bool): Draw the performance overlay
+    - metrics_path (str, optional): File to export the frame metrics
+      to when the window closes
+    - culled (bool): Only draw the points in the camera's view, see
+      ParticleVisualizer
 
     Returns:
     None
     """
-    p_viewer = ParticleVisualizer("Visualize", points)
+    p_viewer = ParticleVisualizer("Visualize", points, num_points,
+                                  budgeted=budgeted, show_hud=show_hud,
+                                  metrics_path=metrics_path, culled=culled)
     while p_viewer.window.running:
         p_viewer.handleInput()
         p_viewer.render()
-        p_viewer.window.show()
+        p_viewer.show()
+    p_viewer.exportMetrics()
+
+
+def renderStream(stream, show_hud=False, metrics_path=None):
+    """
+    Repeatedly draws points to the window while they are being extracted.
+
+    New points are appended to the drawn field as the extractor
+    publishes them, with the extraction progress shown in the window.
+    Uses the same controls as render.
+
+    Parameters:
+    - stream (PointStream): The stream the points are published to
+    - show_hud (bool): Draw the performance overlay
+    - metrics_path (str, optional): File to export the frame metrics
+      to when the window closes
+
+    Returns:
+    None
+    """
+    from conversions.field_arena import FieldArena
+    arena = FieldArena()
+    p_viewer = ParticleVisualizer("Visualize", arena.field, 0,
+                                  show_hud=show_hud,
+                                  metrics_path=metrics_path)
+    while p_viewer.window.running:
+        if arena.count < stream.count:
+            arena.append(stream.read(arena.count))
+            p_viewer.setPoints(arena.field, arena.count)
+        if stream.done:
+            p_viewer.status = None
+        else:
+            p_viewer.status = (f"Extracting: {stream.slices_done}/"
+                               f"{stream.total_slices} slices")
+        p_viewer.handleInput()
+        p_viewer.render()
+        p_viewer.show()
+    p_viewer.exportMetrics()
+    arena.destroy()
+
+
+def renderTiles(tile_dir, memory_cap=512 * 2**20, lod_distance=64.0,
+                show_hud=False, metrics_path=None):
+    """
+    Repeatedly draws a tiled cloud, streaming tiles around the camera.
+
+    Uses the same controls as render.
+
+    Parameters:
+    - tile_dir (str): Directory of the tiled cloud, see tileStack
+    - memory_cap (int): Most bytes of device memory the tiles take,
+      see TileStreamer
+    - lod_distance (float): Distance up to which tiles are drawn at
+      full detail
+    - show_hud (bool): Draw the performance overlay
+    - metrics_path (str, optional): File to export the frame metrics
+      to when the window closes
+
+    Returns:
+    None
+    """
+    from visualizers.tile_streamer import TileStreamer
+    streamer = TileStreamer(tile_dir, memory_cap, lod_distance)
+    p_viewer = ParticleVisualizer("Visualize", streamer.field, 0,
+                                  show_hud=show_hud,
+                                  metrics_path=metrics_path)
+    version = None
+    while p_viewer.window.running:
+        p_viewer.handleInput()
+        streamer.update(p_viewer.cameraPosition())
+        if streamer.version != version:
+            version = streamer.version
+            # the tiles stay in their ranges of the field, only the
+            # drawn ranges are gathered again
+            ranges = streamer.ranges()
+            drawn = sum(count for _, count in ranges)
+            p_viewer.setPoints(streamer.field, drawn)
+            p_viewer.setRanges(ranges)
+            p_viewer.status = (f"Tiles: {drawn}/"
+                               f"{streamer.total_points} points, "
+                               f"{streamer.resident_bytes / 2**20:.0f} MB")
+        p_viewer.render()
+        p_viewer.show()
+    p_viewer.exportMetrics()
+    streamer.close()
+
+
+def renderTimeSeries(sources, size=(128, 128), threshold=None, fps=10.0,
+                     show_hud=False, metrics_path=None):
+    """
+    Repeatedly draws a time series of stacks as an animation.
+
+    Uses the same controls as render, space pauses and resumes, the
+    playback window has a scrub slider.
+
+    Parameters:
+    - sources (list of str): Stacks or PLY files, one per timepoint
+    - size (tuple): Size slices are resized to before extracting
+    - threshold (int, optional): Highest intensity kept in the masks
+    - fps (float): Timepoints shown per second
+    - show_hud (bool): Draw the performance overlay
+    - metrics_path (str, optional): File to export the frame metrics
+      to when the window closes
+
+    Returns:
+    None
+    """
+    from visualizers.playback import TimeSeriesPlayer
+    player = TimeSeriesPlayer(sources, size, threshold, fps)
+    p_viewer = ParticleVisualizer("Visualize", player.field, 0,
+                                  show_hud=show_hud,
+                                  metrics_path=metrics_path)
+    while p_viewer.window.running:
+        for event in p_viewer.window.get_events(ti.ui.PRESS):
+            if event.key == ti.ui.SPACE:
+                player.togglePlaying()
+        p_viewer.handleInput()
+        if player.update():
+            p_viewer.setPoints(player.field, player.count)
+        player.drawControls(p_viewer._gui)
+        p_viewer.render()
+        p_viewer.show()
+    p_viewer.exportMetrics()
+    print(player.status())
+    player.close()
+
+
+def renderComponents(cloud, show_hud=False, metrics_path=None):
+    """
+    Repeatedly draws the components of a cloud, each can be hidden.
+
+    Uses the same controls as render. The largest components are listed
+    with a checkbox and their own color, components with fewer points
+    than the slider are culled. The shown components are gathered into
+    one staging field when they change, so hiding components makes
+    frames cheaper.
+
+    Parameters:
+    - cloud (ComponentCloud): Points grouped by component, see
+      labelComponents
+    - show_hud (bool): Draw the performance overlay
+    - metrics_path (str, optional): File to export the frame metrics
+      to when the window closes
+
+    Returns:
+    None
+    """
+    from conversions.field_arena import FieldArena
+    arena = FieldArena()
+    arena.load(cloud.points)
+    p_viewer = ParticleVisualizer("Visualize", arena.field, arena.count,
+                                  show_hud=show_hud,
+                                  metrics_path=metrics_path)
+    shown = np.ones(len(cloud), dtype=bool)
+    listed = min(len(cloud), len(_component_colors))
+    most_points = max(int(cloud.counts[0]), 1) if len(cloud) > 0 else 1
+    min_points_log = 0.0
+    drawn = None
+    while p_viewer.window.running:
+        p_viewer.handleInput()
+        with p_viewer._gui.sub_window("Components", 0.01, 0.07, 0.4,
+                                      0.5) as w:
+            min_points_log = w.slider_float("Min points (log10)",
+                                            min_points_log, 0.0,
+                                            math.log10(most_points))
+            if w.button("Show all"):
+                shown[:] = True
+            if w.button("Hide all"):
+                shown[:] = False
+            for component in range(listed):
+                shown[component] = w.checkbox(
+                    f"#{cloud.components[component]}: "
+                    f"{cloud.counts[component]} points", shown[component])
+        visible = shown & (cloud.counts >= 10 ** min_points_log)
+        if drawn is None or not np.array_equal(visible, drawn):
+            drawn = visible.copy()
+            # the listed components in their own colors, the rest merged
+            ranges = [(int(cloud.starts[component]),
+                       int(cloud.counts[component]))
+                      for component in range(listed) if visible[component]]
+            colors = [_component_colors[component]
+                      for component in range(listed) if visible[component]]
+            rest = visible.copy()
+            rest[:listed] = False
+            ranges += cloud.ranges(rest)
+            colors += [(1.0, 0.0, 0.0)] * (len(ranges) - len(colors))
+            p_viewer.setRanges(ranges, colors)
+            p_viewer.status = (f"Components: {int(visible.sum())}/"
+                               f"{len(cloud)} shown, "
+                               f"{sum(count for _, count in ranges)}/"
+                               f"{arena.count} points")
+        p_viewer.render()
+        p_viewer.show()
+    p_viewer.exportMetrics()
+    arena.destroy()
+
+
+# colors of the largest components in renderComponents
+_component_colors = [(0.12, 0.47, 0.71), (1.0, 0.5, 0.05), (0.17, 0.63, 0.17),
+                     (0.84, 0.15, 0.16), (0.58, 0.4, 0.74), (0.55, 0.34, 0.29),
+                     (0.89, 0.47, 0.76), (0.5, 0.5, 0.5), (0.74, 0.74, 0.13),
+                     (0.09, 0.75, 0.81)]
+# radius the points are drawn with
+_particle_radius = 0.1
+# fewest points drawn per frame in budgeted mode
+_min_budget = 1024
+
+
+def _shuffleField(field, length):
+    """
+    Shuffle the first length entries of a field in place.
+
+    After this any prefix of the field is a uniform subsample.
+
+    Parameters:
+    - field (ti.Vector.field): The field to shuffle
+    - length (int): Number of entries to shuffle
+    """
+    values = field.to_numpy()
+    np.random.default_rng().shuffle(values[:length])
+    field.from_numpy(values)
 
 
 class ParticleVisualizer():
     """A wrapper class for a taichi scene to render particles."""
 
-    def __init__(self, window_name, particles_pos):
+    def __init__(self, window_name, particles_pos, num_points=None,
+                 budgeted=False, target_frame_time=1 / 30, show_hud=False,
+                 metrics_path=None, culled=False):
         """
         Initialize a new particle visualizer.
 
         Parameters:
         - window_name (str): The name of the window.
-        - particles_pos (list or ndarray): The positions of the particles.
+        - particles_pos (ti.Vector.field): The positions of the particles.
+        - num_points (int, optional): Number of live points at the start
+          of particles_pos, defaults to the whole field.
+        - budgeted (bool): Draw only as many points as fit in the
+          target frame time, filling in the rest when the camera stops.
+          The field is shuffled in place so any prefix is a uniform
+          subsample, the drawn prefix is gathered into a staging field
+          of about its size.
+        - target_frame_time (float): Seconds per frame to aim for
+          in budgeted mode.
+        - show_hud (bool): Draw an overlay with the fps, frame times,
+          points submitted and time spent in each phase of a frame.
+        - metrics_path (str, optional): File exportMetrics writes the
+          frame metrics to, CSV if it ends in .csv else JSON.
+        - culled (bool): Build an octree over the points and only draw
+          the ranges of it inside the camera's view, gathered into one
+          staging field. The field is reordered in place, budgeted is
+          ignored.
 
         Returns:
         - A new particle visualizer
         """
         self._particle_pos = particles_pos
-        self.window = ti.ui.Window(window_name, (768, 768))
+        if num_points is None:
+            num_points = particles_pos.shape[0]
+        self._num_points = num_points
+        self._budgeted = budgeted and not culled
+        self._target_frame_time = target_frame_time
+        # points to draw while moving, adapted to the measured frame time
+        self._moving_budget = min(_min_budget, self._num_points)
+        self._budget = self._moving_budget
+        self._was_moving = False
+        self._last_frame = None
+        self._last_view = None
+        # per frame stats
+        self.points_drawn = 0
+        self.frame_time = 0.0
+        # text shown in the corner of the window
+        self.status = None
+        self.metrics = FrameMetrics()
+        self._show_hud = show_hud
+        self._metrics_path = metrics_path
+        self._input_time = 0.0
+        self._scene_time = 0.0
+        # (offset, count) ranges of the field to draw instead of a prefix
+        self._ranges = None
+        self._range_colors = None
+        # octree of the points when culling, rebuilt by setPoints
+        self.octree = None
+        self._culled = culled
+        # fields the drawn ranges are gathered into, so drawing copies
+        # only them to the vertex buffer
+        self._staging = StagingFields(_min_budget)
+        if self._budgeted:
+            _shuffleField(particles_pos, self._num_points)
+        if culled:
+            self._buildOctree()
+        self._window_size = (768, 768)
+        self.window = ti.ui.Window(window_name, self._window_size)
         self._canvas = self.window.get_canvas()
+        self._gui = self.window.get_gui()
         self._scene = ti.ui.Scene()
         self._camera = ti.ui.Camera()
         # set defaults
@@ -62,12 +354,194 @@ class ParticleVisualizer():
         Doesn't contain loop to draw continuously. Doesn't show
         the resulting window.
         """
+        start = time.perf_counter()
         self._scene.set_camera(self._camera)
         self._scene.point_light(pos=(0.5, 1.5, 1.5), color=(1, 1, 1))
         self._scene.ambient_light((0.8, 0.8, 0.8))
-        self._scene.particles(self._particle_pos,
-                              color=(1.0, 0.0, 0.0), radius=0.1)
+        self._updateBudget()
+        ranges, colors = self._ranges, self._range_colors
+        if ranges is None and self.octree is not None:
+            ranges = self.octree.cull(self._frustum(), _particle_radius)
+        if ranges is None and self.points_drawn < self._num_points:
+            # a budgeted prefix, gathered so the copy follows the budget
+            ranges = [(0, self.points_drawn)]
+        if ranges is not None:
+            # one draw of the ranges gathered together, each range of the
+            # field drawn on its own would copy the whole field
+            field, color_field, self.points_drawn = self._staging.gather(
+                self._particle_pos, ranges, colors)
+            if self.points_drawn > 0:
+                self._scene.particles(field, color=(1.0, 0.0, 0.0),
+                                      radius=_particle_radius,
+                                      per_vertex_color=color_field,
+                                      index_count=self.points_drawn)
+        elif self.points_drawn > 0:
+            self._scene.particles(self._particle_pos,
+                                  color=(1.0, 0.0, 0.0),
+                                  radius=_particle_radius,
+                                  index_count=self.points_drawn)
         self._canvas.scene(self._scene)
+        if self.status is not None:
+            with self._gui.sub_window("Status", 0.01, 0.01, 0.4, 0.05) as w:
+                w.text(self.status)
+        if self._show_hud:
+            self._drawHud()
+        self._scene_time = time.perf_counter() - start
+
+    def show(self):
+        """
+        Present the rendered frame and record its metrics.
+
+        Returns:
+        - None
+        """
+        start = time.perf_counter()
+        self.window.show()
+        present_time = time.perf_counter() - start
+        self.metrics.record(self.frame_time, self.points_drawn,
+                            self._input_time, self._scene_time,
+                            present_time)
+        self._input_time = 0.0
+
+    def exportMetrics(self):
+        """
+        Write the frame metrics to metrics_path if one was given.
+
+        Returns:
+        - str or None: the path written to
+        """
+        if self._metrics_path is None:
+            return None
+        return self.metrics.export(self._metrics_path)
+
+    def _drawHud(self):
+        """Draw the performance overlay."""
+        phases = self.metrics.phaseAverages()
+        with self._gui.sub_window("Performance", 0.6, 0.01, 0.39, 0.4) as w:
+            w.text(f"FPS: {self.metrics.fps():.1f}")
+            w.text(f"Frame: {self.frame_time * 1e3:.1f} ms")
+            w.text(f"Points: {self.points_drawn}/{self._num_points}")
+            if self.octree is not None:
+                w.text(f"Octree: {self.octree.nodes} nodes, built in "
+                       f"{self.octree.build_time * 1e3:.0f} ms")
+            w.text(f"Input: {phases['input'] * 1e3:.2f} ms")
+            w.text(f"Scene: {phases['scene'] * 1e3:.2f} ms")
+            w.text(f"Present: {phases['present'] * 1e3:.2f} ms")
+            histogram = self.metrics.histogram()
+            most = max(max(count for _, count in histogram), 1)
+            for low, count in histogram:
+                bar = "#" * round(20 * count / most)
+                w.text(f"{low:5.1f} ms |{bar}")
+
+    def setPoints(self, particles_pos, num_points=None):
+        """
+        Swap the points drawn by the visualizer.
+
+        Parameters:
+        - particles_pos (ti.Vector.field): The positions of the particles.
+        - num_points (int, optional): Number of live points at the start
+          of particles_pos, defaults to the whole field.
+
+        Returns:
+        - None
+        """
+        if num_points is None:
+            num_points = particles_pos.shape[0]
+        self._particle_pos = particles_pos
+        self._num_points = num_points
+        self._moving_budget = max(min(self._moving_budget, num_points),
+                                  min(_min_budget, num_points))
+        self._budget = self._moving_budget
+        if self._budgeted:
+            _shuffleField(particles_pos, num_points)
+        if self._culled:
+            self._buildOctree()
+        self._staging.invalidate()
+        self._ranges = None
+
+    @property
+    def total_points(self):
+        """Get the number of live points, drawn or not."""
+        return self._num_points
+
+    def _buildOctree(self):
+        """Reorder the live points into an octree for culling."""
+        values = self._particle_pos.to_numpy()
+        self.octree = PointOctree(values[:self._num_points])
+        values[:self._num_points] = self.octree.points
+        self._particle_pos.from_numpy(values)
+
+    def _frustum(self):
+        """
+        Get the planes of the camera's view.
+
+        Returns:
+        - numpy.ndarray: (6, 4) planes, see cameraFrustum
+        """
+        # the field of view and clip distances are the ti.ui.Camera defaults
+        return cameraFrustum(self._camera.curr_position.to_numpy(),
+                             self._camera.curr_lookat.to_numpy(),
+                             self._camera.curr_up.to_numpy(),
+                             aspect=self._window_size[0] /
+                             self._window_size[1])
+
+    def setRanges(self, ranges, colors=None):
+        """
+        Draw only some ranges of the points, or every point again.
+
+        Ranges are drawn whole, budgeted mode doesn't apply to them.
+        They are gathered into one staging field, so hidden points
+        aren't copied to the vertex buffer.
+
+        Parameters:
+        - ranges (list of (int, int) or None): Offset and count of every
+          range to draw, None draws the live points like before
+        - colors (list of tuple, optional): Color of every range
+
+        Returns:
+        - None
+        """
+        self._ranges = None if ranges is None else list(ranges)
+        self._range_colors = None if colors is None else list(colors)
+
+    def _updateBudget(self):
+        """
+        Measure the last frame and pick how many points to draw in this one.
+
+        While the camera moves the budget is scaled toward the target
+        frame time. Once it stops the drawn prefix doubles every frame
+        until the whole cloud is shown.
+        """
+        now = time.perf_counter()
+        if self._last_frame is not None:
+            self.frame_time = now - self._last_frame
+        self._last_frame = now
+
+        if self._ranges is not None:
+            self.points_drawn = sum(count for _, count in self._ranges)
+            return
+        if not self._budgeted:
+            self.points_drawn = self._num_points
+            return
+
+        view = (tuple(self._camera.curr_position.to_numpy()),
+                tuple(self._camera.curr_lookat.to_numpy()))
+        moving = view != self._last_view
+        self._last_view = view
+        if moving:
+            # the frame after a refinement frame isn't representative
+            if self._was_moving and self.frame_time > 0:
+                scale = self._target_frame_time / self.frame_time
+                scale = min(max(scale, 0.5), 2.0)
+                self._moving_budget = int(self._moving_budget * scale)
+                self._moving_budget = max(
+                    min(self._moving_budget, self._num_points),
+                    min(_min_budget, self._num_points))
+            self._budget = self._moving_budget
+        else:
+            self._budget = min(self._budget * 2, self._num_points)
+        self._was_moving = moving
+        self.points_drawn = self._budget
 
     def handleInput(self):
         """
@@ -84,6 +558,7 @@ class ParticleVisualizer():
         Returns:
         - None
         """
+        start = time.perf_counter()
         movement_speed = 0.50
         yaw_speed: float = 10
         pitch_speed: float = 2.0
@@ -142,6 +617,7 @@ class ParticleVisualizer():
 
         self._camera.last_mouse_x = curr_mouse_x
         self._camera.last_mouse_y = curr_mouse_y
+        self._input_time += time.perf_counter() - start
 
     # below functions are called in a /UI/
     def moveBackwardDist(self, dist, front=None):
@@ -222,6 +698,15 @@ class ParticleVisualizer():
         self._camera.position(*(self._camera.curr_position + position_change))
         self._camera.lookat(*(self._camera.curr_lookat + position_change))
 
+    def cameraPosition(self):
+        """
+        Get the position of the camera.
+
+        Returns:
+        - numpy.ndarray: x, y and z of the camera
+        """
+        return self._camera.curr_position.to_numpy()
+
     def _getCameraFront(self):
         """
         Get the normalized direction that the camera is pointing.
@@ -0,0 +1,263 @@
+"""
+Keep the tiles of a tiled cloud near the camera loaded in a taichi field.
+
+Exported classes TileStreamer
+"""
+import threading
+import numpy as np
+from conversions.field_arena import FieldPool
+from conversions.tiled_cloud import readTileIndex, tilePath
+
+# tiles read from disk but not yet copied into the field, bounds the
+# memory held outside of it
+_max_pending = 16
+
+
+class TileStreamer():
+    """
+    Load tiles on a background thread based on where the camera is.
+
+    Close tiles are loaded at full detail and farther tiles at coarser
+    levels. Every loaded tile has its own range of one preallocated
+    field, so loading or evicting a tile copies only its points. The
+    least recently viewed tiles are evicted first when the field is
+    full. Reading the files happens on the loading thread, copying them
+    into the field on the render thread in update.
+    """
+
+    def __init__(self, tile_dir, memory_cap=512 * 2**20, lod_distance=64.0):
+        """
+        Initialize a streamer, allocate its field and start its loading
+        thread.
+
+        Parameters:
+        - tile_dir (str): Directory of the tiled cloud
+        - memory_cap (int): Most bytes of device memory the tiles take,
+          counting the field and the staging fields the drawn ranges
+          of it are gathered into
+        - lod_distance (float): Distance up to which tiles are drawn at
+          full detail, every doubling of it uses the next level
+
+        Returns:
+        - A new tile streamer
+        """
+        self._tile_dir = tile_dir
+        self._index = readTileIndex(tile_dir)
+        self._tiles = self._index["tiles"]
+        num_tiles = len(self._tiles)
+        num_levels = self._index["levels"]
+        self._mins = np.array([tile["min"] for tile in self._tiles],
+                              dtype=np.float32).reshape(-1, 3)
+        self._maxs = np.array([tile["max"] for tile in self._tiles],
+                              dtype=np.float32).reshape(-1, 3)
+        # points in every level of every tile
+        self._counts = np.zeros((num_tiles, num_levels), dtype=np.int64)
+        for tile, info in enumerate(self._tiles):
+            self._counts[tile, :len(info["counts"])] = info["counts"]
+        self._lod_distance = lod_distance
+
+        # the staging fields of a power of two field take at most twice
+        # its size, the field only grows to hold every level of every tile
+        capacity = 1
+        while capacity < self._counts.sum() and \
+                3 * 12 * capacity * 2 <= memory_cap:
+            capacity *= 2
+        self._pool = FieldPool(capacity)
+
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        # start of every tile and level in the field, -1 if not loaded
+        self._offsets = np.full((num_tiles, num_levels), -1, dtype=np.int64)
+        # update count when every tile and level was last wanted
+        self._viewed = np.zeros((num_tiles, num_levels), dtype=np.int64)
+        self._updates = 0
+        # (tile, level, start, points) read but not copied into the field
+        self._pending = []
+        # wanted level of every tile and the tiles closest first
+        self._levels = np.zeros(num_tiles, dtype=np.int64)
+        self._order = np.arange(num_tiles)
+        self._running = True
+        # increases whenever the drawn points change
+        self.version = 0
+        self._thread = threading.Thread(target=self._load, daemon=True)
+        self._thread.start()
+
+    @property
+    def total_points(self):
+        """Get the number of points in the full resolution cloud."""
+        return self._index["points"]
+
+    @property
+    def field(self):
+        """Get the field the tiles are loaded into."""
+        return self._pool.field
+
+    @property
+    def resident_bytes(self):
+        """Get the number of bytes of the field holding tiles."""
+        return self._pool.used * 12
+
+    def update(self, camera_pos):
+        """
+        Pick the tiles and levels to show from the camera position and
+        copy the tiles read since the last call into the field.
+
+        Call once per frame on the render thread.
+
+        Parameters:
+        - camera_pos (array like): Position of the camera
+        """
+        camera_pos = np.asarray(camera_pos, dtype=np.float32)
+        # distance from the camera to the closest point of each tile
+        outside = np.maximum(np.maximum(self._mins - camera_pos,
+                                        camera_pos - self._maxs), 0)
+        distances = np.linalg.norm(outside, axis=1)
+        order = np.argsort(distances, kind="stable")
+        levels = self._level(distances)
+        with self._lock:
+            self._updates += 1
+            self._viewed[np.arange(len(levels)), levels] = self._updates
+            changed = not np.array_equal(levels, self._levels)
+            # keep the order up to date for loading closest first
+            self._order = order
+            self._levels = levels
+            pending, self._pending = self._pending, []
+            if changed or len(pending) > 0:
+                self._wake.notify()
+        for tile, level, start, points in pending:
+            self._pool.write(start, points)
+        with self._lock:
+            for tile, level, start, points in pending:
+                self._offsets[tile, level] = start
+            if changed or len(pending) > 0:
+                self.version += 1
+
+    def ranges(self):
+        """
+        Get the ranges of the field holding the current view.
+
+        Tiles whose wanted level isn't loaded yet are drawn at the
+        finest loaded level. Ranges next to each other are merged.
+
+        Returns:
+        - list of (int, int): offset and count of every range
+        """
+        with self._lock:
+            tiles = np.arange(len(self._levels))
+            loaded = self._offsets >= 0
+            levels = np.where(loaded[tiles, self._levels], self._levels,
+                              np.argmax(loaded, axis=1))
+            drawn = loaded[tiles, levels]
+            starts = self._offsets[tiles[drawn], levels[drawn]]
+            counts = self._counts[tiles[drawn], levels[drawn]]
+        order = np.argsort(starts)
+        starts, counts = starts[order], counts[order]
+        if len(starts) == 0:
+            return []
+        # a range begins wherever the one before doesn't end at it
+        begins = np.flatnonzero(np.r_[True, starts[1:] !=
+                                      starts[:-1] + counts[:-1]])
+        return list(zip(starts[begins].tolist(),
+                        np.add.reduceat(counts, begins).tolist()))
+
+    def close(self):
+        """Stop the loading thread and free the field."""
+        with self._lock:
+            self._running = False
+            self._wake.notify()
+        self._thread.join()
+        self._pool.destroy()
+
+    def _level(self, distances):
+        """
+        Get the levels of detail to show tiles at.
+
+        Parameters:
+        - distances (numpy.ndarray): Distance from the camera to every
+          tile
+
+        Returns:
+        - numpy.ndarray: the level of every tile
+        """
+        ratios = np.maximum(distances / self._lod_distance, 1.0)
+        levels = np.floor(np.log2(ratios)).astype(np.int64) + 1
+        levels[distances < self._lod_distance] = 0
+        return np.minimum(levels, self._index["levels"] - 1)
+
+    def _nextToLoad(self):
+        """
+        Find the closest wanted tile that isn't loaded or being read.
+
+        Called with the lock held.
+
+        Returns:
+        - (int, int) or None: tile and level to load
+        """
+        if len(self._pending) >= _max_pending:
+            return None
+        levels = self._levels[self._order]
+        missing = (self._offsets[self._order, levels] < 0) & \
+            (self._counts[self._order, levels] > 0)
+        for tile, level, _, _ in self._pending:
+            missing &= (self._order != tile) | (levels != level)
+        found = np.flatnonzero(missing)
+        if len(found) == 0:
+            return None
+        return int(self._order[found[0]]), int(levels[found[0]])
+
+    def _load(self):
+        """Load the wanted tiles, closest first, until told to stop."""
+        while True:
+            with self._lock:
+                pair = self._nextToLoad()
+                while self._running and pair is None:
+                    self._wake.wait()
+                    pair = self._nextToLoad()
+                if not self._running:
+                    return
+                tile, level = pair
+                start = self._allocate(int(self._counts[tile, level]))
+                if start is None:
+                    # the view doesn't fit, wait until it changes
+                    version = self.version
+                    while self._running and version == self.version:
+                        self._wake.wait()
+                    continue
+            points = np.fromfile(tilePath(self._tile_dir, level,
+                                          self._tiles[tile]["key"]),
+                                 dtype=np.float32).reshape(-1, 3)
+            with self._lock:
+                self._pending.append((tile, level, start, points))
+
+    def _allocate(self, count):
+        """
+        Reserve a range of the field, evicting the least recently
+        viewed tiles until one fits.
+
+        Tiles at their wanted level are never evicted. Called with the
+        lock held.
+
+        Parameters:
+        - count (int): Number of points in the range
+
+        Returns:
+        - int or None: start of the range, None if it doesn't fit
+        """
+        start = self._pool.allocate(count)
+        if start is not None:
+            return start
+        evictable = self._offsets >= 0
+        evictable[np.arange(len(self._levels)), self._levels] = False
+        # least recently viewed first
+        candidates = np.flatnonzero(evictable)
+        candidates = candidates[np.argsort(self._viewed.flat[candidates],
+                                           kind="stable")]
+        for pair in candidates:
+            tile, level = np.unravel_index(pair, self._offsets.shape)
+            self._pool.free(int(self._offsets[tile, level]))
+            self._offsets[tile, level] = -1
+            self.version += 1
+            start = self._pool.allocate(count)
+            if start is not None:
+                return start
+        return None
@@ -0,0 +1,5 @@
+"""Make the modules in src importable the way main.py imports them."""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
@@ -0,0 +1,67 @@
+"""Tests that FieldArena and FieldPool reuse their fields."""
+import __main__
+import numpy as np
+import pytest
+
+ti = pytest.importorskip("taichi")
+ti.init(arch=ti.cpu)
+# the modules take the initialized taichi from __main__, like main.py
+__main__.ti = ti
+from conversions.field_arena import FieldArena, FieldPool  # noqa: E402
+
+
+def test_reloads_keep_field():
+    rng = np.random.default_rng(0)
+    arena = FieldArena()
+    arena.load(rng.random((10000, 3), dtype=np.float32))
+    capacity, field = arena.capacity, arena.field
+    for _ in range(100):
+        points = rng.random((rng.integers(9000, 11000), 3),
+                            dtype=np.float32)
+        assert arena.load(points) is field
+        assert arena.capacity == capacity
+        assert arena.count == len(points)
+        np.testing.assert_array_equal(field.to_numpy()[:len(points)],
+                                      points)
+    arena.destroy()
+
+
+def test_append_keeps_live_points():
+    rng = np.random.default_rng(1)
+    arena = FieldArena(16)
+    points = rng.random((1000, 3), dtype=np.float32)
+    arena.load(points[:10])
+    for start in range(10, 1000, 99):
+        arena.append(points[start:start + 99])
+    assert arena.count == len(points)
+    assert arena.capacity >= len(points)
+    np.testing.assert_array_equal(arena.field.to_numpy()[:len(points)],
+                                  points)
+    arena.destroy()
+
+
+def test_pool_ranges_stay_put():
+    rng = np.random.default_rng(2)
+    pool = FieldPool(1000)
+    tiles = {}
+    for _ in range(500):
+        if len(tiles) > 0 and rng.random() < 0.5:
+            start = list(tiles)[rng.integers(len(tiles))]
+            pool.free(start)
+            del tiles[start]
+            continue
+        points = rng.random((rng.integers(1, 100), 3), dtype=np.float32)
+        start = pool.allocate(len(points))
+        if start is not None:
+            pool.write(start, points)
+            tiles[start] = points
+        values = pool.field.to_numpy()
+        for start, points in tiles.items():
+            np.testing.assert_array_equal(values[start:start + len(points)],
+                                          points)
+        assert pool.used == sum(len(points) for points in tiles.values())
+    for start in list(tiles):
+        pool.free(start)
+    # freed ranges merge back into one gap
+    assert pool.allocate(1000) == 0
+    pool.destroy()
@@ -0,0 +1,54 @@
+"""Tests that octree culling keeps every point brute force culling keeps."""
+import numpy as np
+import pytest
+from visualizers.octree import PointOctree, bruteForceCull, cameraFrustum
+
+
+def _randomCamera(rng, low, high):
+    position = low + rng.random(3) * (high - low) * 1.4 - (high - low) * 0.2
+    return cameraFrustum(position, position + rng.normal(size=3),
+                         rng.normal(size=3), fov=rng.uniform(20, 90),
+                         aspect=rng.uniform(0.5, 2), far=rng.uniform(5, 1000))
+
+
+def _covered(ranges, num_points):
+    covered = np.zeros(num_points, dtype=bool)
+    for offset, count in ranges:
+        assert not np.any(covered[offset:offset + count])
+        covered[offset:offset + count] = True
+    return covered
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("max_ranges", [1, 4, 16, 10**9])
+def test_cull_keeps_visible_points(seed, max_ranges):
+    rng = np.random.default_rng(seed)
+    # a uniform cloud and a clustered one
+    points = np.concatenate((
+        rng.random((5000, 3)) * 100,
+        rng.normal(50, 3, (5000, 3)))).astype(np.float32)
+    octree = PointOctree(points, leaf_points=64)
+    low, high = points.min(axis=0), points.max(axis=0)
+    for _ in range(20):
+        planes = _randomCamera(rng, low, high)
+        ranges = octree.cull(planes, 0.1, max_ranges)
+        assert len(ranges) <= max_ranges
+        visible = bruteForceCull(octree.points, planes, 0.1)
+        assert not np.any(visible & ~_covered(ranges, len(octree)))
+
+
+def test_points_are_reordered():
+    rng = np.random.default_rng(0)
+    points = rng.random((3000, 3)).astype(np.float32)
+    octree = PointOctree(points, leaf_points=16)
+    np.testing.assert_array_equal(octree.points, points[octree.order])
+    assert np.array_equal(np.sort(octree.order), np.arange(len(points)))
+
+
+@pytest.mark.parametrize("points", [np.zeros((0, 3)), np.ones((500, 3))])
+def test_degenerate_clouds(points):
+    octree = PointOctree(points, leaf_points=8)
+    planes = cameraFrustum((0, 0, -5), (1, 1, 1), (0, 1, 0))
+    visible = bruteForceCull(octree.points, planes)
+    covered = _covered(octree.cull(planes), len(octree))
+    assert not np.any(visible & ~covered)